@@ -0,0 +1,1085 @@
+#!/usr/bin/env python3
+"""A stand-in i3/sway IPC server for benchmarking without a live session.
+
+The server speaks the i3 IPC wire protocol on a Unix socket. It either models
+a tree from a scripted scenario, where a useful subset of commands is applied
+and the matching events are emitted, or replays a trace recorded from a real
+session with `replay.py record`.  """
+
+import argparse
+import itertools
+import json
+import logging
+import os
+import queue
+import re
+import socket
+import struct
+import threading
+import time
+
+
+###############################################################################
+# Protocol                                                                    #
+###############################################################################
+
+MAGIC = b'i3-ipc'
+HEADER = struct.Struct('=6sII')
+
+RUN_COMMAND = 0
+GET_WORKSPACES = 1
+SUBSCRIBE = 2
+GET_OUTPUTS = 3
+GET_TREE = 4
+GET_MARKS = 5
+GET_BAR_CONFIG = 6
+GET_VERSION = 7
+GET_BINDING_MODES = 8
+GET_CONFIG = 9
+SEND_TICK = 10
+
+EVENTS = {
+    'workspace': 0,
+    'output': 1,
+    'mode': 2,
+    'window': 3,
+    'barconfig_update': 4,
+    'binding': 5,
+    'shutdown': 6,
+    'tick': 7
+    }
+EVENT_BIT = 1 << 31
+
+
+def pack(msg_type, payload):
+    """Pack a message with the i3 IPC header."""
+    if not isinstance(payload, bytes):
+        payload = json.dumps(payload).encode('utf-8')
+    return HEADER.pack(MAGIC, len(payload), msg_type) + payload
+
+
+def recv_exact(sock, size):
+    """Receive exactly size bytes, or None at end of stream."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_message(sock):
+    """Read one message and return the type and raw payload."""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None, None
+    magic, length, msg_type = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Invalid magic string: {}'.format(magic))
+    payload = recv_exact(sock, length)
+    if payload is None:
+        return None, None
+    return msg_type, payload
+
+
+###############################################################################
+# Tree model                                                                  #
+###############################################################################
+
+RECT = {'x': 0, 'y': 0, 'width': 1920, 'height': 1080}
+ORIENTATION = {
+    'splith': 'horizontal',
+    'tabbed': 'horizontal',
+    'splitv': 'vertical',
+    'stacked': 'vertical',
+    'output': 'none'
+    }
+DIRECTIONS = {
+    'left': ('horizontal', -1),
+    'right': ('horizontal', 1),
+    'up': ('vertical', -1),
+    'down': ('vertical', 1)
+    }
+CRITERIA = re.compile(r'^\s*\[(\w+)="?([^"\]]*)"?\]\s*(.*)$', re.DOTALL)
+
+
+class CommandError(Exception):
+    """A command that the mock can not apply."""
+
+
+class MockTree:
+    """A mutable i3 layout tree with a subset of the i3 command semantics.
+
+    Parameters
+    ----------
+    workspaces : dict
+        Workspace names mapped to lists of window names
+    outputs : int, optional
+        The number of outputs the workspaces are spread over
+    focus : str, optional
+        The name of the initially focused workspace
+
+    """
+
+    def __init__(self, workspaces=None, outputs=1, focus=None):
+        self.ids = itertools.count(94000000000000, 16)
+        self.windows = itertools.count(1)
+        self.emit = lambda kind, payload: None
+        self.root = self.node('root', 'root', 'splith')
+        self.nodes = {}
+        self.parents = {}
+        self.scratch = self.node('workspace', '__i3_scratch', 'splith')
+        internal = self.node('output', '__i3', 'output')
+        content = self.node('con', 'content', 'splith')
+        content['nodes'].append(self.scratch)
+        internal['nodes'].append(content)
+        self.root['nodes'].append(internal)
+        contents = []
+        for index in range(max(outputs, 1)):
+            output = self.node('output', 'MOCK-{}'.format(index + 1),
+                               'output')
+            for dock in ['topdock', 'bottomdock']:
+                output['nodes'].append(self.node('dockarea', dock, 'dockarea'))
+            content = self.node('con', 'content', 'splith')
+            output['nodes'].insert(1, content)
+            contents.append(content)
+            self.root['nodes'].append(output)
+        workspaces = workspaces or {'1': []}
+        for index, (name, windows) in enumerate(workspaces.items()):
+            wrk = self.node('workspace', str(name), 'splith')
+            wrk['num'] = int(name) if str(name).isdigit() else -1
+            for title in windows:
+                wrk['nodes'].append(self.window(title))
+            contents[index % len(contents)]['nodes'].append(wrk)
+        self.reindex()
+        for con in self.nodes.values():
+            con['focus'] = [n['id'] for n in con['nodes']
+                            + con['floating_nodes']]
+        target = self.workspace_named(focus or str(next(iter(workspaces))))
+        self.focused = None
+        self.focus(self.first_leaf(target), emit=False)
+
+    @classmethod
+    def from_tree(cls, tree):
+        """Create a model from a GET_TREE reply."""
+        model = cls.__new__(cls)
+        model.emit = lambda kind, payload: None
+        model.root = tree
+        model.nodes = {}
+        model.parents = {}
+        model.reindex()
+        model.ids = itertools.count(max(model.nodes) + 16, 16)
+        model.windows = itertools.count(
+            max([n.get('window') or 0 for n in model.nodes.values()]) + 1)
+        model.scratch = next((n for n in model.nodes.values()
+                              if n['name'] == '__i3_scratch'), None)
+        model.focused = next((n for n in model.nodes.values()
+                              if n.get('focused')), None)
+        return model
+
+    def node(self, kind, name, layout):
+        """Create a new container."""
+        return {
+            'id': next(self.ids),
+            'type': kind,
+            'name': name,
+            'layout': layout,
+            'orientation': ORIENTATION.get(layout, 'none'),
+            'border': 'pixel',
+            'current_border_width': 2,
+            'percent': None,
+            'rect': dict(RECT),
+            'window_rect': dict(RECT),
+            'deco_rect': dict(RECT),
+            'geometry': dict(RECT),
+            'window': None,
+            'urgent': False,
+            'marks': [],
+            'focused': False,
+            'focus': [],
+            'fullscreen_mode': 0,
+            'floating': 'auto_off',
+            'sticky': False,
+            'scratchpad_state': 'none',
+            'nodes': [],
+            'floating_nodes': []
+            }
+
+    def window(self, title):
+        """Create a new window container."""
+        con = self.node('con', title, 'splith')
+        con['window'] = next(self.windows)
+        con['window_properties'] = {'class': title, 'instance': title,
+                                    'title': title}
+        return con
+
+    # Navigation.
+
+    def reindex(self):
+        """Rebuild the id and parent indexes."""
+        self.nodes.clear()
+        self.parents.clear()
+        stack = [self.root]
+        while stack:
+            con = stack.pop()
+            self.nodes[con['id']] = con
+            for child in con['nodes'] + con['floating_nodes']:
+                self.parents[child['id']] = con
+                stack.append(child)
+
+    def parent(self, con):
+        """Get the parent of a container."""
+        return self.parents.get(con['id'])
+
+    def workspace(self, con):
+        """Get the workspace of a container."""
+        while con is not None and con['type'] != 'workspace':
+            con = self.parent(con)
+        return con
+
+    def workspaces(self):
+        """Get all workspaces except the scratchpad."""
+        return [n for n in self.nodes.values()
+                if n['type'] == 'workspace' and n['name'] != '__i3_scratch']
+
+    def workspace_named(self, name):
+        """Find a workspace by name, creating it when needed."""
+        for wrk in self.workspaces():
+            if wrk['name'] == name:
+                return wrk
+        content = next(n for n in self.root['nodes'][-1]['nodes']
+                       if n['name'] == 'content')
+        wrk = self.node('workspace', name, 'splith')
+        wrk['num'] = int(name) if name.isdigit() else -1
+        content['nodes'].append(wrk)
+        self.reindex()
+        return wrk
+
+    def first_leaf(self, con):
+        """Follow the focus stack down to a leaf."""
+        while con['nodes'] or con['floating_nodes']:
+            children = {n['id']: n for n in con['nodes']
+                        + con['floating_nodes']}
+            con = children.get(con['focus'][0] if con['focus'] else None,
+                               (con['nodes'] or con['floating_nodes'])[0])
+        return con
+
+    def leaves(self, con):
+        """Get the tiled and floating windows below a container."""
+        if not con['nodes'] and not con['floating_nodes']:
+            return [con] if con['window'] else []
+        leaves = []
+        for child in con['nodes'] + con['floating_nodes']:
+            leaves.extend(self.leaves(child))
+        return leaves
+
+    def marked(self, mark):
+        """Find the container with the specified mark."""
+        for con in self.nodes.values():
+            if mark in con['marks']:
+                return con
+        raise CommandError('No container matches mark {}'.format(mark))
+
+    # Mutation.
+
+    def detach(self, con):
+        """Detach a container and close emptied split containers."""
+        parent = self.parent(con)
+        key = 'floating_nodes' if con in parent['floating_nodes'] \
+            else 'nodes'
+        parent[key].remove(con)
+        if con['id'] in parent['focus']:
+            parent['focus'].remove(con['id'])
+        del self.parents[con['id']]
+        if parent['type'] == 'con' and not parent['nodes'] \
+                and not parent['floating_nodes'] and parent['window'] is None:
+            self.detach(parent)
+            self.nodes.pop(parent['id'], None)
+        return parent
+
+    def attach(self, con, parent, index=None, floating=False):
+        """Attach a container to a parent."""
+        key = 'floating_nodes' if floating else 'nodes'
+        if index is None:
+            index = len(parent[key])
+        parent[key].insert(index, con)
+        parent['focus'].append(con['id'])
+        self.parents[con['id']] = parent
+
+    def focus(self, con, emit=True):
+        """Focus a container and update the focus stacks."""
+        if self.focused is not None:
+            self.focused['focused'] = False
+        old = self.workspace(self.focused) if self.focused else None
+        con['focused'] = True
+        self.focused = con
+        child = con
+        parent = self.parent(con)
+        while parent is not None:
+            if child['id'] in parent['focus']:
+                parent['focus'].remove(child['id'])
+            parent['focus'].insert(0, child['id'])
+            child, parent = parent, self.parent(parent)
+        new = self.workspace(con)
+        if emit and new is not None and old is not new:
+            self.emit('workspace', {'change': 'focus', 'current': new,
+                                    'old': old})
+        if emit and con['window']:
+            self.emit('window', {'change': 'focus', 'container': con})
+
+    def set_layout(self, con, layout):
+        """Set the layout of a container."""
+        con['layout'] = layout
+        con['orientation'] = ORIENTATION.get(layout, 'none')
+
+    def wrap(self, con, layout):
+        """Replace a container with a new split container holding it."""
+        parent = self.parent(con)
+        split = self.node('con', None, layout)
+        index = parent['nodes'].index(con)
+        parent['nodes'][index] = split
+        parent['focus'] = [split['id'] if i == con['id'] else i
+                           for i in parent['focus']]
+        self.parents[split['id']] = parent
+        split['nodes'].append(con)
+        split['focus'].append(con['id'])
+        self.parents[con['id']] = split
+        return split
+
+    def new_window(self, title, workspace=None):
+        """Open a new window next to the focused window.
+
+        With a workspace, the window is opened next to the focused window of
+        that workspace without taking the focus, as with `assign`.
+
+        """
+        con = self.window(title)
+        target = self.focused
+        if workspace is not None:
+            target = self.workspace_named(str(workspace))
+            while target['focus']:
+                target = self.nodes[target['focus'][0]]
+        if target['floating'].endswith('on'):
+            target = self.workspace(target)
+        if target['type'] == 'workspace' or target['window'] is None:
+            self.attach(con, target)
+        else:
+            parent = self.parent(target)
+            self.attach(con, parent, parent['nodes'].index(target) + 1)
+        self.nodes[con['id']] = con
+        self.emit('window', {'change': 'new', 'container': con})
+        if workspace is None:
+            self.focus(con)
+        return con
+
+    def close(self, con):
+        """Close a window and focus the next window of its workspace."""
+        wrk = self.workspace(con)
+        self.detach(con)
+        del self.nodes[con['id']]
+        con['focused'] = False
+        self.emit('window', {'change': 'close', 'container': con})
+        if self.focused is con:
+            self.focused = None
+            self.focus(self.first_leaf(wrk))
+
+    # Commands.
+
+    def run(self, payload):
+        """Run a command chain and return the list of command results."""
+        results = []
+        for part in payload.split(';'):
+            part = part.strip()
+            targets = None
+            match = CRITERIA.match(part)
+            if match:
+                key, value, part = match.groups()
+                targets = self.criteria(key, value)
+            for cmd in part.split(','):
+                cmd = cmd.strip()
+                if not cmd:
+                    continue
+                try:
+                    if targets == []:
+                        raise CommandError('No window matches given criteria')
+                    for con in targets or [self.focused]:
+                        self.command(con, cmd.split())
+                    results.append({'success': True})
+                except CommandError as err:
+                    results.append({'success': False, 'parse_error': False,
+                                    'error': str(err)})
+        return results
+
+    def criteria(self, key, value):
+        """Resolve command criteria to a list of containers."""
+        if key == 'con_id':
+            con = self.nodes.get(int(value)) if value.isdigit() else None
+            return [con] if con else []
+        if key == 'con_mark':
+            return [n for n in self.nodes.values() if value in n['marks']]
+        raise CommandError('Unsupported criteria: {}'.format(key))
+
+    def command(self, con, args):
+        """Apply a single command to a container."""
+        # pylint: disable=too-many-branches
+        name = args[0]
+        if name in ['nop', 'resize', 'border', 'exec', 'opacity']:
+            if name == 'opacity':
+                con['opacity'] = float(args[1])
+        elif name == 'focus':
+            self.command_focus(con, args[1:])
+        elif name == 'mark':
+            self.command_mark(con, args[1:])
+        elif name == 'unmark':
+            removed = [con] if len(args) == 1 else \
+                [n for n in self.nodes.values() if args[1] in n['marks']]
+            for target in removed:
+                target['marks'] = [m for m in target['marks']
+                                   if len(args) > 1 and m != args[1]]
+                if target['window']:
+                    self.emit('window', {'change': 'mark',
+                                         'container': target})
+        elif name == 'move':
+            self.command_move(con, args[1:])
+        elif name == 'swap':
+            self.command_swap(con, args[1:])
+        elif name == 'layout':
+            self.command_layout(con, args[1:])
+        elif name in ['split', 'splitv', 'splith', 'splitt']:
+            mode = args[1][0] if name == 'split' else name[-1]
+            self.command_split(con, mode)
+        elif name == 'fullscreen':
+            mode = args[1] if len(args) > 1 else 'toggle'
+            enable = mode == 'enable' or \
+                (mode == 'toggle' and not con['fullscreen_mode'])
+            con['fullscreen_mode'] = 1 if enable else 0
+            self.emit('window', {'change': 'fullscreen_mode',
+                                 'container': con})
+        elif name == 'floating':
+            self.command_floating(con, args[1] if len(args) > 1 else 'toggle')
+        elif name == 'kill':
+            self.close(con)
+        elif name == 'workspace':
+            self.command_workspace(args[1:])
+        else:
+            raise CommandError('Unknown command: {}'.format(' '.join(args)))
+
+    def command_focus(self, con, args):
+        """Apply the focus command."""
+        if not args:
+            self.focus(con)
+        elif args[0] == 'child':
+            if con['nodes']:
+                children = {n['id']: n for n in con['nodes']}
+                self.focus(children.get(con['focus'][0], con['nodes'][0]))
+        elif args[0] == 'parent':
+            parent = self.parent(con)
+            if parent['type'] != 'content':
+                self.focus(parent)
+        elif args[0] in DIRECTIONS:
+            orientation, step = DIRECTIONS[args[0]]
+            child, parent = con, self.parent(con)
+            while parent['type'] != 'workspace' \
+                    and parent['orientation'] != orientation:
+                child, parent = parent, self.parent(parent)
+            if parent['orientation'] == orientation:
+                index = parent['nodes'].index(child) + step
+                if 0 <= index < len(parent['nodes']):
+                    self.focus(self.first_leaf(parent['nodes'][index]))
+        else:
+            raise CommandError('Unsupported focus: {}'.format(args[0]))
+
+    def command_mark(self, con, args):
+        """Apply the mark command."""
+        add = '--add' in args
+        toggle = '--toggle' in args
+        mark = [a for a in args if not a.startswith('--')][0]
+        if toggle and mark in con['marks']:
+            con['marks'].remove(mark)
+        else:
+            for other in self.nodes.values():
+                if mark in other['marks'] and other is not con:
+                    other['marks'].remove(mark)
+            con['marks'] = (con['marks'] if add else []) + [mark]
+        if con['window']:
+            self.emit('window', {'change': 'mark', 'container': con})
+
+    def command_move(self, con, args):
+        """Apply the move command."""
+        if args and args[0] in ['container', 'window']:
+            args = args[1:]
+        if args[:2] == ['to', 'mark']:
+            target = self.marked(args[2])
+            if target is con:
+                return
+            self.detach(con)
+            if target['nodes'] or target['window'] is None:
+                self.attach(con, target)
+            else:
+                parent = self.parent(target)
+                self.attach(con, parent, parent['nodes'].index(target) + 1)
+        elif args[:2] == ['to', 'workspace']:
+            target = self.workspace_named(args[2])
+            self.detach(con)
+            self.attach(con, target)
+        elif args and args[0] in DIRECTIONS:
+            self.move_direction(con, *DIRECTIONS[args[0]])
+        else:
+            raise CommandError('Unsupported move: {}'.format(' '.join(args)))
+        if con['window']:
+            self.emit('window', {'change': 'move', 'container': con})
+
+    def move_direction(self, con, orientation, step):
+        """Move a container within or out of its parent."""
+        parent = self.parent(con)
+        if parent['orientation'] == orientation:
+            index = parent['nodes'].index(con) + step
+            if 0 <= index < len(parent['nodes']):
+                nodes = parent['nodes']
+                nodes[index - step], nodes[index] = nodes[index], con
+                return
+        if parent['type'] == 'workspace':
+            if parent['orientation'] != orientation \
+                    and len(parent['nodes']) > 1:
+                split = self.node('con', None, parent['layout'])
+                split['nodes'] = parent['nodes']
+                split['focus'] = parent['focus']
+                for child in split['nodes']:
+                    self.parents[child['id']] = split
+                parent['nodes'] = [split]
+                parent['focus'] = [split['id']]
+                self.parents[split['id']] = parent
+                self.set_layout(parent, 'splith' if orientation
+                                == 'horizontal' else 'splitv')
+                self.detach(con)
+                self.attach(con, parent, 0 if step < 0 else None)
+            return
+        anchor = parent
+        while self.parent(anchor)['type'] != 'workspace' \
+                and self.parent(anchor)['orientation'] != orientation:
+            anchor = self.parent(anchor)
+        grand = self.parent(anchor)
+        self.detach(con)
+        index = grand['nodes'].index(anchor) if anchor in grand['nodes'] \
+            else len(grand['nodes'])
+        self.attach(con, grand, index + (1 if step > 0 else 0))
+
+    def command_swap(self, con, args):
+        """Apply the swap command."""
+        if args[:2] != ['container', 'with']:
+            raise CommandError('Unsupported swap: {}'.format(' '.join(args)))
+        if args[2] == 'con_id':
+            other = self.nodes.get(int(args[3])) if args[3].isdigit() \
+                else None
+        else:
+            other = self.marked(args[3])
+        if other is None:
+            raise CommandError('Swap target not found')
+        if other is con:
+            return
+        first, second = self.parent(con), self.parent(other)
+        index1, index2 = first['nodes'].index(con), \
+            second['nodes'].index(other)
+        first['nodes'][index1], second['nodes'][index2] = other, con
+        self.parents[con['id']], self.parents[other['id']] = second, first
+        first['focus'] = [other['id'] if i == con['id'] else i
+                          for i in first['focus']]
+        if second is not first:
+            second['focus'] = [con['id'] if i == other['id'] else i
+                               for i in second['focus']]
+
+    def command_layout(self, con, args):
+        """Apply the layout command to the parent of the container."""
+        if con['type'] != 'workspace':
+            con = self.parent(con)
+        if args[0] == 'toggle':
+            options = args[1:] if len(args) > 2 else \
+                ['splith', 'splitv'] if args[1:] in [['split'], []] \
+                else ['stacked', 'tabbed', 'splith', 'splitv']
+            options = [o if o != 'split' else 'splith' for o in options]
+            if 'splith' in options and 'splitv' not in options:
+                options.insert(options.index('splith') + 1, 'splitv')
+            current = con['layout'] if con['layout'] in options else None
+            layout = options[(options.index(current) + 1) % len(options)] \
+                if current else options[0]
+        else:
+            layout = {'stacking': 'stacked', 'default': 'splith'}.get(
+                args[0], args[0])
+        if con['type'] == 'workspace' and con['nodes']:
+            split = self.node('con', None, layout)
+            split['nodes'] = con['nodes']
+            split['focus'] = con['focus']
+            for child in split['nodes']:
+                self.parents[child['id']] = split
+            con['nodes'] = [split]
+            con['focus'] = [split['id']]
+            self.parents[split['id']] = con
+            self.nodes[split['id']] = split
+        else:
+            self.set_layout(con, layout)
+
+    def command_split(self, con, mode):
+        """Apply the split command."""
+        layout = {'v': 'splitv', 'h': 'splith', 't': None}[mode]
+        parent = self.parent(con)
+        if layout is None:
+            layout = 'splitv' if parent['orientation'] == 'horizontal' \
+                else 'splith'
+        if con['type'] == 'workspace':
+            self.set_layout(con, layout)
+        elif len(parent['nodes']) == 1 and \
+                parent['layout'] in ['splith', 'splitv']:
+            self.set_layout(parent, layout)
+        else:
+            split = self.wrap(con, layout)
+            self.nodes[split['id']] = split
+
+    def command_floating(self, con, mode):
+        """Apply the floating command."""
+        floating = con['floating'].endswith('on')
+        enable = mode == 'enable' or (mode == 'toggle' and not floating)
+        if enable == floating:
+            return
+        wrk = self.workspace(con)
+        self.detach(con)
+        self.attach(con, wrk, floating=enable)
+        con['floating'] = 'user_on' if enable else 'user_off'
+        self.emit('window', {'change': 'floating', 'container': con})
+
+    def command_workspace(self, args):
+        """Apply the workspace command."""
+        target = self.workspace_named(' '.join(args))
+        self.focus(self.first_leaf(target))
+
+
+###############################################################################
+# Server                                                                      #
+###############################################################################
+
+class MockServer:
+    """Serve a tree model or a recorded trace over the i3 IPC protocol.
+
+    Parameters
+    ----------
+    path : str
+        The Unix socket path
+    model : MockTree, optional
+        The tree model used in scripted mode
+    trace : list, optional
+        The entries of a recorded trace used in replay mode
+    variant : str, optional
+        The window manager to impersonate, i3 or sway
+    settle : float, optional
+        Wait for this many seconds without requests after each step instead
+        of waiting for an acknowledgement from the client
+    latency : float, optional
+        Seconds that every request takes before it is answered, as the round
+        trip to a busy window manager (default none)
+
+    """
+
+    def __init__(self, path, model=None, trace=None, variant='i3',
+                 settle=None, latency=0.0):
+        self.path = path
+        self.settle = settle
+        self.latency = latency
+        self.last_request = time.monotonic()
+        self.model = model
+        self.variant = variant
+        self.lock = threading.RLock()
+        self.clients = []
+        self.acked = threading.Condition(self.lock)
+        self.ack = 0
+        self.emitted = 0
+        self.emitted_at = []
+        self.requests = {}
+        self.running = True
+        self.trace = None
+        self.trees = []
+        self.tree = None
+        if trace is not None:
+            self.load_trace(trace)
+        if model is not None:
+            model.emit = self.emit
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock.bind(path)
+        self.sock.listen(8)
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def load_trace(self, trace):
+        """Split a trace into the events and the tree replies after each."""
+        self.trace = []
+        pending = self.trees
+        for entry in trace:
+            if entry['kind'] == 'version':
+                self.variant = entry['payload'].get('variant', 'i3')
+            elif entry['kind'] == 'tree':
+                pending.append(entry['payload'])
+            elif entry['kind'] == 'event':
+                pending = []
+                self.trace.append((entry, pending))
+        self.tree = self.trees[0] if self.trees else None
+
+    def close(self):
+        """Stop serving and remove the socket."""
+        self.running = False
+        self.sock.close()
+        for client in self.clients:
+            client[2].put(None)
+            client[0].close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def accept(self):
+        """Accept client connections."""
+        while self.running:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                break
+            client = [conn, set(), queue.Queue()]
+            with self.lock:
+                self.clients.append(client)
+            threading.Thread(target=self.serve, args=(client,),
+                             daemon=True).start()
+            threading.Thread(target=self.write, args=(client,),
+                             daemon=True).start()
+
+    def serve(self, client):
+        """Answer the requests of one client."""
+        conn = client[0]
+        while self.running:
+            try:
+                msg_type, payload = read_message(conn)
+            except OSError:
+                break
+            if msg_type is None:
+                break
+            if self.latency:
+                time.sleep(self.latency)
+            with self.lock:
+                self.last_request = time.monotonic()
+                self.requests[msg_type] = self.requests.get(msg_type, 0) + 1
+                reply = json.dumps(self.reply(
+                    client, msg_type, payload.decode('utf-8', 'replace')))
+                # Queued under the lock, a reply on a subscribed connection
+                # is in order with the events as with i3.
+                self.send(client, msg_type, reply.encode('utf-8'))
+            if msg_type == SUBSCRIBE and 'tick' in client[1]:
+                self.send(client, EVENT_BIT | EVENTS['tick'],
+                          {'first': True, 'payload': ''})
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+        client[2].put(None)
+
+    def write(self, client):
+        """Send the queued messages of one client in order.
+
+        The messages are buffered per client, as i3 does, so the events of a
+        command are queued while the client still waits for the reply, and a
+        client that does not read its events cannot block the server.
+
+        """
+        while True:
+            data = client[2].get()
+            if data is None:
+                break
+            try:
+                client[0].sendall(data)
+            except OSError:
+                break
+
+    def send(self, client, msg_type, payload):
+        """Queue a message to a client."""
+        client[2].put(pack(msg_type, payload))
+
+    def reply(self, client, msg_type, payload):
+        """Compute the reply to a request."""
+        # pylint: disable=too-many-return-statements
+        if msg_type == RUN_COMMAND:
+            match = re.match(r'^nop mock-ack (\d+)$', payload)
+            if match:
+                self.ack = max(self.ack, int(match.group(1)))
+                self.acked.notify_all()
+                return [{'success': True}]
+            if self.model is None:
+                count = len([c for c in re.split(r'[;,]', payload)
+                             if c.strip()])
+                return [{'success': True}] * max(count, 1)
+            return self.model.run(payload)
+        if msg_type == SUBSCRIBE:
+            client[1].update(json.loads(payload))
+            return {'success': True}
+        if msg_type == GET_TREE:
+            if self.model is not None:
+                return self.model.root
+            if self.trees:
+                self.tree = self.trees.pop(0)
+            return self.tree
+        if msg_type == GET_VERSION:
+            version = {'major': 4, 'minor': 18, 'patch': 1,
+                       'human_readable': 'mock', 'loaded_config_file_name':
+                       '/dev/null'}
+            if self.variant == 'sway':
+                version.update({'major': 1, 'minor': 5, 'patch': 0,
+                                'variant': 'sway'})
+            return version
+        if msg_type == GET_WORKSPACES:
+            return self.get_workspaces()
+        if msg_type == GET_MARKS:
+            nodes = self.model.nodes.values() if self.model else []
+            return [m for n in nodes for m in n['marks']]
+        if msg_type == SEND_TICK:
+            self.emit('tick', {'first': False, 'payload': payload})
+            return {'success': True}
+        if msg_type in [GET_OUTPUTS, GET_BAR_CONFIG, GET_BINDING_MODES]:
+            return []
+        if msg_type == GET_CONFIG:
+            return {'config': ''}
+        return {'success': False, 'error': 'unsupported message'}
+
+    def get_workspaces(self):
+        """Compute the GET_WORKSPACES reply."""
+        if self.model is None:
+            return []
+        focused = self.model.workspace(self.model.focused)
+        return [{'id': w['id'], 'num': w.get('num', -1), 'name': w['name'],
+                 'visible': w is focused, 'focused': w is focused,
+                 'urgent': False, 'rect': w['rect'], 'output': 'MOCK-1'}
+                for w in self.model.workspaces()]
+
+    def emit(self, kind, payload, raw=False):
+        """Send an event to all subscribed clients."""
+        with self.lock:
+            data = payload if raw else json.dumps(payload).encode('utf-8')
+            self.emitted += 1
+            if kind != 'tick':
+                self.emitted_at.append(time.monotonic())
+            clients = [c for c in self.clients if kind in c[1]]
+        for client in clients:
+            self.send(client, EVENT_BIT | EVENTS[kind], data)
+
+    def barrier(self, timeout=5.0):
+        """Wait until the subscribers have handled all emitted events.
+
+        A tick is sent and the client acknowledges it with a `nop mock-ack`
+        command once all earlier events are handled. The tick is repeated
+        until no new events were emitted in the meantime.
+
+        """
+        deadline = time.monotonic() + timeout
+        if self.settle is not None:
+            while time.monotonic() < deadline:
+                idle = time.monotonic() - self.last_request
+                if idle >= self.settle:
+                    return True
+                time.sleep(self.settle - idle)
+            return False
+        counter = itertools.count(self.ack + 1)
+        with self.lock:
+            while self.running and time.monotonic() < deadline:
+                number = next(counter)
+                emitted = self.emitted
+                self.emit('tick', {'first': False,
+                                   'payload': 'mock-barrier {}'
+                                   .format(number)})
+                while self.ack < number and time.monotonic() < deadline:
+                    self.acked.wait(deadline - time.monotonic())
+                if self.emitted == emitted + 1:
+                    return True
+        logging.warning('Barrier timed out')
+        return False
+
+    def play(self, steps):
+        """Apply scenario steps, waiting for the clients after each one."""
+        for step in steps:
+            if not self.running:
+                return
+            if 'repeat' in step:
+                for _ in range(step['repeat']):
+                    self.play(step['steps'])
+                continue
+            if 'sleep' in step:
+                time.sleep(step['sleep'])
+                continue
+            with self.lock:
+                for burst in step.get('burst', [step]):
+                    self.step(burst)
+            self.barrier()
+
+    def step(self, step):
+        """Apply a single scenario step to the model."""
+        model = self.model
+        if 'new' in step:
+            model.new_window(step['new'], step.get('on'))
+        elif 'close' in step:
+            model.close(model.focused)
+        elif 'binding' in step:
+            command = step['binding']
+            if not command.startswith('nop'):
+                model.run(command)
+            self.emit('binding', {'change': 'run', 'binding': {
+                'command': command, 'event_state_mask': ['Mod4'],
+                'input_code': 0, 'symbol': step.get('symbol', 'x'),
+                'input_type': 'keyboard', 'mods': ['Mod4']}})
+        elif 'workspace' in step:
+            model.command_workspace([str(step['workspace'])])
+        elif 'command' in step:
+            model.run(step['command'])
+        elif 'floating' in step:
+            model.command_floating(model.focused, step['floating'])
+        else:
+            raise ValueError('Unknown step: {}'.format(step))
+
+    def replay(self):
+        """Emit the events of a recorded trace."""
+        for entry, trees in self.trace:
+            if not self.running:
+                return
+            with self.lock:
+                self.trees = list(trees)
+                self.emit(entry['type'],
+                          json.dumps(entry['payload']).encode('utf-8'),
+                          raw=True)
+            self.barrier()
+
+    def done(self):
+        """Signal the end of the scenario to the clients."""
+        self.emit('tick', {'first': False, 'payload': 'mock-done'})
+
+
+###############################################################################
+# Scenarios                                                                   #
+###############################################################################
+
+def load_scenario(path):
+    """Load a scenario from a JSON file."""
+    with open(path) as stream:
+        return json.load(stream)
+
+
+def default_scenario(workspaces=8, windows=8, rounds=5):
+    """Generate a scenario of a typical editing session."""
+    names = [str(i + 1) for i in range(workspaces)]
+    steps = []
+    for name in names:
+        steps.append({'workspace': name})
+        steps.extend({'new': 'term'} for _ in range(windows))
+    actions = [
+        'nop i3ipc_focus next', 'nop i3ipc_focus prev',
+        'nop i3ipc_focus other', 'nop i3ipc_focus toggle',
+        'nop i3ipc_move next', 'nop i3ipc_move prev',
+        'nop i3ipc_move other', 'nop i3ipc_move swap',
+        'nop i3ipc_monocle_toggle', 'nop i3ipc_focus next',
+        'nop i3ipc_monocle_toggle', 'nop i3ipc_tabbed_toggle',
+        'nop i3ipc_focus next', 'nop i3ipc_tabbed_toggle',
+        'nop i3ipc_reflect', 'nop i3ipc_mirror', 'nop i3ipc_reflect',
+        'layout toggle tabbed split', 'layout toggle tabbed split'
+        ]
+    loop = [{'binding': a} for a in actions]
+    loop.extend([{'new': 'term'}, {'close': True}])
+    for name in names:
+        loop.append({'workspace': name})
+        loop.append({'binding': 'nop i3ipc_focus next'})
+    steps.append({'repeat': rounds, 'steps': loop})
+    return {'variant': 'i3', 'workspaces': {'1': []}, 'steps': steps}
+
+
+def nested_scenario(windows=8, depth=3, rounds=5):
+    """Generate a scenario repositioning windows in nested split containers.
+
+    The secondary container gets a chain of nested split containers of
+    alternating orientation, each holding a new window, and the focused
+    window is moved to the first, the last and an inner position in turn.
+
+    """
+    steps = [{'workspace': '1'}]
+    steps.extend({'new': 'term'} for _ in range(windows))
+    steps.append({'sleep': 0.1})
+    for level in range(depth):
+        steps.append({'command': 'splitv' if level % 2 else 'splith'})
+        steps.append({'new': 'term'})
+    steps.append({'sleep': 0.1})
+    loop = [{'binding': 'nop i3ipc_move first'},
+            {'binding': 'nop i3ipc_move last'},
+            {'binding': 'nop i3ipc_move index 2'}]
+    steps.append({'repeat': rounds, 'steps': loop})
+    return {'variant': 'i3', 'workspaces': {'1': []}, 'steps': steps}
+
+
+def burst_scenario(workspaces=8, windows=8, rounds=5):
+    """Generate a scenario of events that arrive in bursts.
+
+    The steps of a burst are applied at once, without waiting for the
+    clients in between, so the events pile up while the handlers run. Every
+    round opens windows on all workspaces, as a restored session does, runs
+    a series of bindings and closes the windows of the focused workspace.
+
+    """
+    names = [str(i + 1) for i in range(workspaces)]
+    actions = [
+        'nop i3ipc_focus next', 'nop i3ipc_move next',
+        'nop i3ipc_monocle_toggle', 'nop i3ipc_focus next',
+        'nop i3ipc_monocle_toggle', 'nop i3ipc_reflect',
+        'nop i3ipc_move swap', 'nop i3ipc_focus other'
+        ]
+    steps = [{'workspace': names[0]}]
+    loop = [{'burst': [{'new': 'term', 'on': name} for name in names
+                       for _ in range(windows)]},
+            {'burst': [{'binding': a} for a in actions]},
+            {'burst': [{'close': True}] * windows}]
+    steps.append({'repeat': rounds, 'steps': loop})
+    return {'variant': 'i3', 'workspaces': {'1': []}, 'steps': steps}
+
+
+def create_server(path, scenario=None, trace=None):
+    """Create a server for a scenario or a recorded trace."""
+    if trace is not None:
+        return MockServer(path, trace=trace)
+    scenario = scenario or default_scenario()
+    if 'tree' in scenario:
+        model = MockTree.from_tree(scenario['tree'])
+    else:
+        model = MockTree(scenario.get('workspaces'),
+                         scenario.get('outputs', 1), scenario.get('focus'))
+    return MockServer(path, model=model,
+                      variant=scenario.get('variant', 'i3'))
+
+
+def main():
+    """Serve a scenario until interrupted."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--socket', default='/tmp/i3ipc-mock.sock',
+                        help='The socket path to listen on.')
+    parser.add_argument('--scenario', help='A JSON scenario file.')
+    parser.add_argument('--settle', type=float, default=0.05,
+                        help="""Seconds without requests that mark the end of
+                        the daemon's reaction to a step.""")
+    parser.add_argument('--play', action='store_true',
+                        help="""Play the scenario steps once a client has
+                        subscribed, otherwise only serve the initial tree.""")
+    args = parser.parse_args()
+    scenario = load_scenario(args.scenario) if args.scenario else None
+    server = create_server(args.socket, scenario)
+    server.settle = args.settle
+    print('Listening on {}'.format(args.socket))
+    try:
+        if args.play:
+            while not any(c[1] for c in server.clients):
+                time.sleep(0.1)
+            server.play((scenario or default_scenario())['steps'])
+            server.done()
+        server.thread.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
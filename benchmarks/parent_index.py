@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""Measure the parent lookups on workspaces of increasing size.
+
+A workspace with a main container holding one window and a secondary
+container holding the rest is built with the mock tree. For each size the
+script reports the cost of get_workspace_info() and the mean cost of one
+parent lookup with the former descendant scan and with the parent index.
+
+Examples
+--------
+    python3 benchmarks/parent_index.py
+    python3 benchmarks/parent_index.py --sizes 10 100 1000 --repeat 20
+
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import i3ipc
+
+import mock_ipc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import i3ipc_dynamic_tiling as daemon  # noqa: E402 pylint: disable=C0413
+
+
+def scan_parent_id(con_id, info):
+    """Find the parent container id by scanning all descendants."""
+    parent = None
+    containers = (con for con in info.descendants if not con.name)
+    for con in containers:
+        for dsc in con.descendants():
+            if dsc.id == con_id:
+                parent = con.id
+                break
+    return parent
+
+
+def index_parent_id(con_id, info):
+    """Find the parent container id with the parent index."""
+    parent = info.parents.get(con_id)
+    while parent in info.cons and info.cons[parent].name:
+        parent = info.parents.get(parent)
+    return parent if parent in info.cons else None
+
+
+def nest(model, leaves, layouts, fanout=4):
+    """Nest the windows in split containers with at most fanout children."""
+    if len(leaves) <= fanout or not layouts:
+        return leaves
+    size = -(-len(leaves) // fanout)
+    nodes = []
+    for start in range(0, len(leaves), size):
+        split = model.node('con', None, layouts[0])
+        split['nodes'] = nest(model, leaves[start:start + size], layouts[1:],
+                              fanout)
+        split['focus'] = [c['id'] for c in split['nodes']]
+        nodes.append(split)
+    return nodes
+
+
+def build_workspace(windows, layout='splitv', nesting=(), fullscreen=False):
+    """Build a managed workspace with the specified number of windows.
+
+    The main container holds one window and the secondary container the rest,
+    the last window is focused so that the index lookups scan all windows.
+
+    Parameters
+    ----------
+    windows : int
+        The number of windows, at least two
+    layout : str, optional
+        The layout of the secondary container (default 'splitv')
+    nesting : sequence, optional
+        The layouts of the split containers that the windows of the secondary
+        container are nested in, from the outermost to the innermost level
+        (default none)
+    fullscreen : bool, optional
+        Make the secondary container fullscreen (default False)
+
+    """
+    model = mock_ipc.MockTree({'1': ['term'] * windows})
+    wrk = model.workspace_named('1')
+    leaves = list(wrk['nodes'])
+    leaves[-1]['focused'] = True
+    wrk['nodes'] = []
+    for key, children, split_layout in [
+            ('MAIN', leaves[:1], 'splitv'),
+            ('SCND', nest(model, leaves[1:], list(nesting)), layout)]:
+        split = model.node('con', None, split_layout)
+        split['marks'] = ['I3DT_{}_1'.format(key)]
+        split['nodes'] = children
+        split['focus'] = [c['id'] for c in reversed(children)]
+        wrk['nodes'].append(split)
+    if fullscreen:
+        wrk['nodes'][-1]['fullscreen_mode'] = 1
+    wrk['focus'] = [c['id'] for c in reversed(wrk['nodes'])]
+    return i3ipc.Con(wrk, None, None)
+
+
+def timed(function, number):
+    """Get the time of a number of calls of a function in seconds."""
+    start = time.perf_counter()
+    for _ in range(number):
+        function()
+    return time.perf_counter() - start
+
+
+def measure(function, repeat, minimum=0.0):
+    """Get the best mean time of one call in milliseconds.
+
+    The function is called once per repetition, or in runs of a power of ten
+    calls that take at least minimum seconds.
+
+    """
+    number = 1
+    while minimum and timed(function, number) < minimum:
+        number *= 10
+    best = min(timed(function, number) for _ in range(repeat))
+    return best / number * 1000.0
+
+
+def main():
+    """Run the benchmark and print a table."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10, 25, 50, 100, 250, 500],
+                        help='Windows per workspace.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Repetitions, the best one is reported.')
+    args = parser.parse_args()
+
+    print('{:>8}{:>12}{:>12}{:>12}{:>10}'.format(
+        'windows', 'info_ms', 'scan_ms', 'index_ms', 'speedup'))
+    for size in args.sizes:
+        workspace = build_workspace(size)
+        info = daemon.get_workspace_info(None, workspace)
+        ids = info.tiled
+        for cid in ids:
+            assert scan_parent_id(cid, info) == index_parent_id(cid, info)
+        build = measure(lambda: daemon.get_workspace_info(None, workspace),
+                        args.repeat)
+        scan = measure(lambda: [scan_parent_id(c, info) for c in ids],
+                       args.repeat) / len(ids)
+        index = measure(lambda: [index_parent_id(c, info) for c in ids],
+                        args.repeat) / len(ids)
+        print('{:>8}{:>12.3f}{:>12.4f}{:>12.4f}{:>10.0f}'.format(
+            size, build, scan, index, scan / index))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+#!/usr/bin/env python3
+"""Record i3/sway sessions and replay them against the daemon.
+
+`record` starts a proxy socket between the daemon and the window manager and
+writes every event, tree reply and command to a trace file. `replay` serves a
+trace or a scripted scenario with the mock IPC server, runs the daemon
+handlers against it and reports per-handler latency and IPC round trips.
+`check` replays windows repositioned in nested split containers for several
+numbers of windows and fails when the number of commands per binding grows.
+
+Examples
+--------
+    I3SOCK=/tmp/i3dt-proxy.sock python3 i3ipc_dynamic_tiling.py &
+    python3 benchmarks/replay.py record --output session.jsonl
+
+    python3 benchmarks/replay.py replay --trace session.jsonl
+    python3 benchmarks/replay.py replay -- --opacity-inactive 0.8
+    python3 benchmarks/replay.py replay --burst -- --workers 2
+    python3 benchmarks/replay.py replay --latency 2 -- --asyncio true
+    python3 benchmarks/replay.py check --sizes 4 16 64
+
+"""
+
+import argparse
+import asyncio
+import functools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import i3ipc
+from i3ipc import Event
+from i3ipc._private import MessageType
+
+import mock_ipc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import i3ipc_dynamic_tiling as daemon  # noqa: E402 pylint: disable=C0413
+
+HANDLERS = [
+    'on_binding', 'on_window_new', 'on_window_close', 'on_window_focus',
+    'on_window_move', 'on_window_floating', 'on_workspace_focus',
+    'i3ipc_focus', 'i3ipc_move', 'i3ipc_reflect', 'i3ipc_mirror',
+    'i3ipc_monocle_toggle', 'i3ipc_tabbed_toggle', 'i3ipc_kill',
+    'i3ipc_layout', 'tree_on_window', 'tree_on_workspace'
+    ]
+HELPERS = ['get_workspace_info', 'execute_commands', 'create_container',
+           'reconcile']
+EVENT_NAMES = {v: k for k, v in mock_ipc.EVENTS.items()}
+
+
+###############################################################################
+# Record                                                                      #
+###############################################################################
+
+class Recorder:
+    """Write trace entries as JSON lines."""
+
+    def __init__(self, path):
+        self.stream = open(path, 'w')
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def write(self, kind, payload, **extra):
+        """Write a trace entry."""
+        entry = {'t': round(time.monotonic() - self.start, 6), 'kind': kind,
+                 'payload': payload}
+        entry.update(extra)
+        with self.lock:
+            self.stream.write(json.dumps(entry) + '\n')
+            self.stream.flush()
+
+
+def relay(source, sink, recorder, upstream):
+    """Forward messages from source to sink and record the relevant ones."""
+    while True:
+        try:
+            msg_type, payload = mock_ipc.read_message(source)
+        except (OSError, ValueError):
+            break
+        if msg_type is None:
+            break
+        if upstream and msg_type == mock_ipc.RUN_COMMAND:
+            recorder.write('command', payload.decode('utf-8', 'replace'))
+        elif not upstream and msg_type & mock_ipc.EVENT_BIT:
+            name = EVENT_NAMES.get(msg_type & 0x7f, str(msg_type & 0x7f))
+            recorder.write('event', json.loads(payload), type=name)
+        elif not upstream and msg_type == mock_ipc.GET_TREE:
+            recorder.write('tree', json.loads(payload))
+        try:
+            sink.sendall(mock_ipc.pack(msg_type, payload))
+        except OSError:
+            break
+    for sock in [source, sink]:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def record(args):
+    """Proxy the window manager socket and record the session."""
+    ipc = i3ipc.Connection(args.upstream)
+    recorder = Recorder(args.output)
+    recorder.write('version', ipc.get_version().ipc_data)
+    recorder.write('tree', json.loads(ipc._message(MessageType.GET_TREE, '')))
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen(8)
+    print('Recording {} through {}'.format(ipc.socket_path, args.socket))
+    try:
+        while True:
+            client, _ = server.accept()
+            upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            upstream.connect(ipc.socket_path)
+            for source, sink, direction in [(client, upstream, True),
+                                            (upstream, client, False)]:
+                threading.Thread(target=relay, daemon=True, args=(
+                    source, sink, recorder, direction)).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(args.socket)
+
+
+###############################################################################
+# Replay                                                                      #
+###############################################################################
+
+class Stats:
+    """Collect latency and IPC round trips per handler."""
+
+    def __init__(self):
+        self.ipc = {'trips': 0, 'tree': 0, 'command': 0, 'chained': 0,
+                    'bytes': 0}
+        self.samples = {}
+        self.received_at = []
+        self.enabled = False
+
+    def received(self, original):
+        """Wrap the event publisher to record when the events are read."""
+        def wrapper(name, event):
+            if name not in ['tick', 'ipc_shutdown']:
+                self.received_at.append(time.monotonic())
+            return original(name, event)
+        return wrapper
+
+    def lag(self, emitted_at):
+        """Get the p95 and the maximum wait of the events on the socket.
+
+        The events of the mock are read in the order they were emitted, the
+        wait is the time from the emission until the daemon read the event.
+
+        """
+        waits = sorted((read - emitted) * 1000.0 for read, emitted in
+                       zip(self.received_at, emitted_at))
+        if not waits:
+            return {'p95_ms': 0.0, 'max_ms': 0.0}
+        return {'p95_ms': percentile(waits, 0.95), 'max_ms': waits[-1]}
+
+    def message(self, original):
+        """Wrap Connection._message to count round trips and bytes."""
+        def wrapper(message_type, payload):
+            data = original(message_type, payload)
+            if self.enabled:
+                self.ipc['trips'] += 1
+                self.ipc['bytes'] += len(payload) + len(data)
+                if message_type == MessageType.GET_TREE:
+                    self.ipc['tree'] += 1
+                elif message_type == MessageType.COMMAND:
+                    self.ipc['command'] += 1
+                    self.ipc['chained'] += len(
+                        [c for c in payload.split(';') if c.strip()])
+            return data
+        return wrapper
+
+    def timed(self, name, function):
+        """Wrap a daemon function to record its inclusive cost.
+
+        The commands the function buffered are credited to it by the daemon
+        when they are sent.
+
+        """
+        def wrapper(*args, **kwargs):
+            before = dict(self.ipc)
+            frame = daemon.meter_enter(functools.partial(self.record, name))
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                sample = {k: self.ipc[k] - before[k] for k in self.ipc}
+                sample['time'] = time.perf_counter() - start
+                daemon.meter_exit(frame, sample)
+        return wrapper
+
+    def record(self, name, sample):
+        """Keep the complete sample of a call."""
+        if self.enabled:
+            self.samples.setdefault(name, []).append(sample)
+
+    def summary(self):
+        """Summarize the samples per handler."""
+        result = {}
+        for name, samples in sorted(self.samples.items()):
+            times = sorted(s['time'] * 1000.0 for s in samples)
+            count = len(samples)
+            result[name] = {
+                'calls': count,
+                'mean_ms': sum(times) / count,
+                'p50_ms': percentile(times, 0.50),
+                'p95_ms': percentile(times, 0.95),
+                'max_ms': times[-1],
+                'trips': sum(s['trips'] for s in samples) / count,
+                'trees': sum(s['tree'] for s in samples) / count,
+                'commands': sum(s['command'] for s in samples) / count,
+                'chained': sum(s['chained'] for s in samples) / count,
+                'chained_max': max(s['chained'] for s in samples),
+                'kbytes': sum(s['bytes'] for s in samples) / count / 1024.0
+                }
+        return result
+
+
+def percentile(values, fraction):
+    """Get a percentile of a sorted list."""
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def report(summary, stream=sys.stdout):
+    """Print the summary as a table."""
+    columns = ['calls', 'mean_ms', 'p50_ms', 'p95_ms', 'max_ms', 'trips',
+               'trees', 'commands', 'chained', 'kbytes']
+    stream.write('{:<22}'.format('handler')
+                 + ''.join('{:>10}'.format(c) for c in columns) + '\n')
+    for name, row in summary.items():
+        cells = ['{:>10}'.format(row[c]) if c == 'calls'
+                 else '{:>10.3f}'.format(row[c]) for c in columns]
+        stream.write('{:<22}'.format(name) + ''.join(cells) + '\n')
+
+
+def replay(args):
+    """Replay a trace or scenario and measure the daemon handlers."""
+    trace = scenario = None
+    if args.trace:
+        with open(args.trace) as stream:
+            trace = [json.loads(line) for line in stream if line.strip()]
+    elif args.scenario:
+        scenario = mock_ipc.load_scenario(args.scenario)
+    else:
+        generate = mock_ipc.default_scenario
+        if args.burst:
+            generate = mock_ipc.burst_scenario
+        scenario = generate(args.workspaces, args.windows, args.rounds)
+    path = os.path.join(tempfile.mkdtemp(), 'ipc.sock')
+    server = mock_ipc.create_server(path, scenario, trace)
+    server.latency = args.latency / 1000.0
+
+    ipc = i3ipc.Connection(path)
+    stats = Stats()
+    acknowledge = ipc._message
+    ipc._message = stats.message(acknowledge)
+    ipc._pubsub.emit = stats.received(ipc._pubsub.emit)
+    for name in HANDLERS + HELPERS:
+        setattr(daemon, name, stats.timed(name, getattr(daemon, name)))
+
+    def on_tick(ipc, event):
+        daemon.dispatch_wait()
+        if event.payload.startswith('mock-barrier'):
+            acknowledge(MessageType.COMMAND,
+                        'nop mock-ack {}'.format(event.payload.split()[-1]))
+        elif event.payload == 'mock-done' and daemon.DATA['asyncio']:
+            daemon.async_quit()
+        elif event.payload == 'mock-done':
+            ipc.main_quit()
+
+    sys.argv = ['i3ipc_dynamic_tiling.py', '--state-file', '',
+                '--log-level', args.log_level] + args.daemon_args
+    daemon.init(ipc)
+
+    def run():
+        try:
+            if daemon.DATA['asyncio']:
+                asyncio.run(daemon.main_async(ipc, [(Event.TICK, on_tick)]))
+                return
+            daemon.subscribe(ipc)
+            ipc.on(Event.TICK, on_tick)
+            ipc.main()
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('The daemon stopped')
+            server.running = False
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    while not any('tick' in c[1] for c in server.clients):
+        time.sleep(0.01)
+
+    start = time.perf_counter()
+    stats.enabled = True
+    if trace is not None:
+        server.replay()
+    else:
+        server.play(scenario['steps'])
+    server.done()
+    thread.join(30.0)
+    stats.enabled = False
+    elapsed = time.perf_counter() - start
+    server.close()
+
+    summary = stats.summary()
+    lag = stats.lag(server.emitted_at)
+    report(summary)
+    print('\nTotal {:.3f} s, {} round trips, server requests {}'.format(
+        elapsed, stats.ipc['trips'],
+        {MessageType(k).name: v for k, v in sorted(server.requests.items())}))
+    if stats.received_at:
+        print('Events wait to be read p95 {:.3f} ms, max {:.3f} ms'.format(
+            lag['p95_ms'], lag['max_ms']))
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump({'elapsed': elapsed, 'ipc': stats.ipc, 'lag': lag,
+                       'handlers': summary}, stream, indent=2)
+
+
+def check(args):
+    """Check that the reposition bindings send a fixed number of commands.
+
+    Every size is replayed in a separate process, as the daemon keeps its
+    state in module globals, and the largest number of commands sent for one
+    binding is compared between the sizes.
+
+    """
+    counts = dict()
+    print('{:>8}{:>10}'.format('windows', 'commands'))
+    for size in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            scenario = os.path.join(directory, 'nested.json')
+            output = os.path.join(directory, 'result.json')
+            with open(scenario, 'w') as stream:
+                json.dump(mock_ipc.nested_scenario(size, args.depth,
+                                                   args.rounds), stream)
+            subprocess.run([sys.executable, os.path.abspath(__file__),
+                            'replay', '--scenario', scenario, '--output',
+                            output, '--log-level', 'error'],
+                           check=True, stdout=subprocess.DEVNULL)
+            with open(output) as stream:
+                result = json.load(stream)
+        counts[size] = result['handlers']['on_binding']['chained_max']
+        print('{:>8}{:>10}'.format(size, counts[size]))
+    if len(set(counts.values())) > 1:
+        print('The number of commands depends on the number of windows')
+        sys.exit(1)
+
+
+def main():
+    """Parse the command line and run the sub command."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    sub = parser.add_subparsers(dest='action', required=True)
+
+    rec = sub.add_parser('record', help='Record a session through a proxy.')
+    rec.add_argument('--output', required=True, help='The trace file.')
+    rec.add_argument('--socket', default='/tmp/i3dt-proxy.sock',
+                     help='The proxy socket the daemon should connect to.')
+    rec.add_argument('--upstream', default=None,
+                     help='The window manager socket (default detected).')
+
+    rep = sub.add_parser('replay', help='Replay a trace or scenario.')
+    rep.add_argument('--trace', help='A trace recorded with `record`.')
+    rep.add_argument('--scenario', help='A JSON scenario for the mock.')
+    rep.add_argument('--workspaces', type=int, default=8,
+                     help='Workspaces in the default scenario.')
+    rep.add_argument('--windows', type=int, default=8,
+                     help='Windows per workspace in the default scenario.')
+    rep.add_argument('--rounds', type=int, default=5,
+                     help='Rounds of actions in the default scenario.')
+    rep.add_argument('--burst', action='store_true',
+                     help='Send the events of the scenario in bursts.')
+    rep.add_argument('--latency', type=float, default=0.0,
+                     help='Milliseconds the mock takes for every request.')
+    rep.add_argument('--output', help='Write the results as JSON.')
+    rep.add_argument('--log-level', default='warning',
+                     help='The logging level of the daemon.')
+    rep.add_argument('daemon_args', nargs=argparse.REMAINDER,
+                     help='Arguments passed to the daemon after --.')
+
+    chk = sub.add_parser('check', help='Count the commands of the reposition '
+                         'bindings on nested layouts.')
+    chk.add_argument('--sizes', type=int, nargs='+', default=[4, 16, 64],
+                     help='Windows on the workspace.')
+    chk.add_argument('--depth', type=int, default=3,
+                     help='Nested split containers in the secondary one.')
+    chk.add_argument('--rounds', type=int, default=3,
+                     help='Rounds of reposition bindings.')
+
+    args = parser.parse_args()
+    if getattr(args, 'daemon_args', None) and args.daemon_args[0] == '--':
+        args.daemon_args = args.daemon_args[1:]
+    if args.action == 'record':
+        record(args)
+    elif args.action == 'check':
+        check(args)
+    else:
+        replay(args)
+
+
+if __name__ == '__main__':
+    main()
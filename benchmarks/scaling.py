@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""Measure how the pure helpers scale with the size of a workspace.
+
+Workspaces from a few to a thousand windows are built with the mock tree, in
+several shapes: a flat secondary container, nested split containers and
+mixes of tabbed and stacked containers. For each workspace the script
+reports the mean cost of one call and the peak allocation, traced with
+tracemalloc, of the helpers that run on every event. The lookups that take a
+container id are measured over all windows and reported per call.
+
+The results can be written as JSON and compared against an earlier run, the
+script exits with a non-zero status when a helper got slower or allocates
+more than the tolerance allows.
+
+Examples
+--------
+    python3 benchmarks/scaling.py
+    python3 benchmarks/scaling.py --sizes 2 100 1000 --shapes flat mixed
+    python3 benchmarks/scaling.py --output base.json
+    python3 benchmarks/scaling.py --baseline base.json --tolerance 0.5
+
+"""
+
+import argparse
+import json
+import math
+import os
+import sys
+import tracemalloc
+
+import parent_index
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import i3ipc_dynamic_tiling as daemon  # noqa: E402 pylint: disable=C0413
+
+# The layout of the secondary container and of the nested split containers,
+# from the outermost to the innermost level.
+SHAPES = {
+    'flat': ('splitv', []),
+    'nested': ('splitv', ['splith', 'splitv', 'splith']),
+    'tabbed': ('tabbed', []),
+    'mixed': ('stacked', ['tabbed', 'splith', 'stacked'])
+    }
+
+
+def build_workspace(windows, shape, fullscreen=False):
+    """Build a managed workspace of the specified shape."""
+    layout, nesting = SHAPES[shape]
+    return parent_index.build_workspace(windows, layout, nesting, fullscreen)
+
+
+def each(function, items, *args):
+    """Call a function for every item without keeping the results."""
+    def run():
+        for item in items:
+            function(item, *args)
+    return run
+
+
+def allocated(function):
+    """Get the peak memory allocated by one call in bytes."""
+    function()
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def cases(size, shape):
+    """Get the helpers to measure on one workspace.
+
+    Returns
+    -------
+    list
+        Tuples of the helper name, the function to call, the number of calls
+        it makes and the layouts to store before each measurement.
+
+    """
+    workspace = build_workspace(size, shape)
+    info = daemon.get_workspace_info(None, workspace)
+    full = daemon.get_workspace_info(None, build_workspace(size, shape, True))
+    tiled = info.tiled
+    saved = {'main': 'splitv', 'scnd': 'splith'}
+    return [
+        ('get_workspace_info',
+         lambda: daemon.get_workspace_info(None, workspace), 1, None),
+        ('find_split_parent',
+         each(lambda cid: daemon.find_split_parent(info, cid), tiled),
+         len(tiled), None),
+        ('find_parent_container_key',
+         each(lambda cid: daemon.find_parent_container_key(info, cid), tiled),
+         len(tiled), None),
+        ('find_container_index',
+         lambda: daemon.find_container_index(info), 1, None),
+        ('restore_container_layout',
+         lambda: daemon.restore_container_layout('scnd', info), 1, saved),
+        ('i3ipc_monocle_enable_commands',
+         lambda: daemon.i3ipc_monocle_enable_commands('scnd', info), 1,
+         None),
+        ('i3ipc_monocle_disable_commands',
+         lambda: daemon.i3ipc_monocle_disable_commands('scnd', full), 1,
+         saved),
+        ('i3ipc_monocle_toggle_commands',
+         lambda: daemon.i3ipc_monocle_toggle_commands('scnd', full), 1,
+         saved)
+        ]
+
+
+def run(args):
+    """Measure all helpers on all workspaces."""
+    results = []
+    for shape in args.shapes:
+        for size in args.sizes:
+            for name, function, calls, saved in cases(size, shape):
+                if saved:
+                    daemon.I3DT_LAYOUT['1'] = dict(saved)
+                elapsed = parent_index.measure(function, args.repeat,
+                                                 0.005) / calls
+                if saved:
+                    daemon.I3DT_LAYOUT['1'] = dict(saved)
+                peak = allocated(function)
+                results.append({'shape': shape, 'windows': size,
+                                'helper': name, 'mean_ms': elapsed,
+                                'peak_bytes': peak})
+    return results
+
+
+def exponents(results):
+    """Estimate the growth of each helper between the two largest sizes.
+
+    An exponent close to one means that the cost grows linearly with the
+    number of windows, close to two quadratically.
+
+    """
+    series = {}
+    for row in results:
+        series.setdefault((row['shape'], row['helper']), []).append(row)
+    growth = {}
+    for (shape, helper), rows in sorted(series.items()):
+        rows = sorted(rows, key=lambda r: r['windows'])
+        if len(rows) < 2 or rows[-2]['mean_ms'] <= 0:
+            continue
+        small, large = rows[-2], rows[-1]
+        growth.setdefault(shape, {})[helper] = (
+            math.log(large['mean_ms'] / small['mean_ms'])
+            / math.log(large['windows'] / small['windows']))
+    return growth
+
+
+def compare(results, baseline, tolerance):
+    """Find the helpers that regressed compared with an earlier run."""
+    before = {(r['shape'], r['windows'], r['helper']): r
+              for r in baseline['results']}
+    regressions = []
+    for row in results:
+        base = before.get((row['shape'], row['windows'], row['helper']))
+        if not base:
+            continue
+        for metric in ['mean_ms', 'peak_bytes']:
+            if row[metric] > base[metric] * (1.0 + tolerance):
+                regressions.append(
+                    '{} {} {} windows: {} {:.4g} -> {:.4g}'.format(
+                        row['helper'], row['shape'], row['windows'], metric,
+                        base[metric], row[metric]))
+    return regressions
+
+
+def report(results, growth, stream=sys.stdout):
+    """Print the results as a table."""
+    stream.write('{:<32}{:>8}{:>8}{:>12}{:>12}\n'.format(
+        'helper', 'shape', 'windows', 'mean_ms', 'peak_kb'))
+    for row in results:
+        stream.write('{:<32}{:>8}{:>8}{:>12.4f}{:>12.1f}\n'.format(
+            row['helper'], row['shape'], row['windows'], row['mean_ms'],
+            row['peak_bytes'] / 1024.0))
+    stream.write('\nGrowth exponent between the two largest sizes\n')
+    for shape, helpers in growth.items():
+        for helper, exponent in helpers.items():
+            stream.write('{:<32}{:>8}{:>8.2f}\n'.format(
+                helper, shape, exponent))
+
+
+def main():
+    """Run the benchmark, print a table and compare with a baseline."""
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[2, 10, 50, 100, 250, 500, 1000],
+                        help='Windows per workspace, at least two.')
+    parser.add_argument('--shapes', nargs='+', default=list(SHAPES),
+                        choices=list(SHAPES),
+                        help='The shapes of the workspaces.')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Repetitions, the best one is reported.')
+    parser.add_argument('--output', help='Write the results as JSON.')
+    parser.add_argument('--baseline',
+                        help='Compare with the JSON of an earlier run.')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='The allowed relative increase (default 0.5).')
+    args = parser.parse_args()
+    if min(args.sizes) < 2:
+        parser.error('A managed workspace needs at least two windows.')
+
+    results = run(args)
+    growth = exponents(results)
+    report(results, growth)
+    if args.output:
+        with open(args.output, 'w') as stream:
+            json.dump({'sizes': args.sizes, 'shapes': args.shapes,
+                       'repeat': args.repeat, 'results': results,
+                       'growth': growth}, stream, indent=2)
+    if args.baseline:
+        with open(args.baseline) as stream:
+            regressions = compare(results, json.load(stream), args.tolerance)
+        for line in regressions:
+            print('Regression: {}'.format(line))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
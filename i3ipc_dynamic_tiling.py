@@ -6,218 +6,2574 @@ managers, trying to mimic the tiling behavior of the excellent DWM and XMONAD
 window managers, while utilizing the strengths of I3 and SWAY.  """
 
 import argparse
+import asyncio
+import atexit
+import collections
+import concurrent.futures
 import copy
+import cProfile
+import errno
+import functools
+import glob
+import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import re
 import signal
+import socket
+import struct
+import subprocess
 import sys
+import threading
+import time
 import i3ipc
 from i3ipc import Event
 
+# The raw tree reply is read through the private message interface of i3ipc
+# when it is available, otherwise through the public get_tree().
+try:
+    from i3ipc._private import MessageType
+except ImportError:
+    MessageType = None
+
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 
 ###############################################################################
 # Logging                                                                     #
 ###############################################################################
 
-# Create the logger.
+class RingHandler(logging.Handler):
+    """Keep the most recent log records in memory.
+
+    The records are only formatted when they are dumped.
+
+    Parameters
+    ----------
+    capacity : int
+        The number of records to keep
+
+    """
+
+    def __init__(self, capacity):
+        super().__init__(logging.DEBUG)
+        self.records = collections.deque(maxlen=capacity)
+
+    def emit(self, record):
+        """Keep a record."""
+        self.records.append(record)
+
+    def dump(self):
+        """Format the kept records."""
+        return '\n'.join(self.format(r) for r in list(self.records))
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Queue the log records without formatting them.
+
+    The QueueHandler formats the message on the thread that logs it, here the
+    record is queued as is and formatted by the listener thread. Only the
+    traceback of an exception is rendered right away, so the queued record
+    does not keep the frames of the handler alive.
+
+    """
+
+    def prepare(self, record):
+        """Get a copy of the record that can be formatted later."""
+        record = copy.copy(record)
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = logging.Formatter().formatException(
+                    record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def logging_setup(level, capacity=0):
+    """Configure the logging of the daemon.
+
+    The records at the specified level are passed through a queue to a
+    listener thread that formats and writes them to stderr. With a capacity,
+    the debug records are also kept in a ring buffer that can be dumped.
+
+    Parameters
+    ----------
+    level : str
+        The logging level, for example 'info'
+    capacity : int, optional
+        The number of debug records kept in memory (default none)
+
+    """
+    level = getattr(logging, level.upper())
+    formatter = logging.Formatter('%(asctime)s %(levelname)s: %(message)s')
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    if LOG['listener'] is not None:
+        LOG['listener'].stop()
+    stream = logging.StreamHandler()
+    stream.setFormatter(formatter)
+    LOG['listener'] = logging.handlers.QueueListener(
+        LOG['queue'], stream, respect_handler_level=False)
+    LOG['listener'].start()
+    output = DeferredQueueHandler(LOG['queue'])
+    output.setLevel(level)
+    root.addHandler(output)
+    LOG['ring'] = None
+    if capacity > 0:
+        LOG['ring'] = RingHandler(capacity)
+        LOG['ring'].setFormatter(formatter)
+        root.addHandler(LOG['ring'])
+        level = logging.DEBUG
+    root.setLevel(level)
+
+
+def logging_stop():
+    """Write the queued records before the process exits."""
+    if LOG['listener'] is not None:
+        LOG['listener'].stop()
+        LOG['listener'] = None
+
+
+def logging_dump(stream=None):
+    """Get the records of the ring buffer, or write them to a stream."""
+    text = LOG['ring'].dump() if LOG['ring'] is not None else ''
+    if stream is not None:
+        stream.write(text + '\n')
+        stream.flush()
+    return text
+
+
+atexit.register(logging_stop)
+
+###############################################################################
+# Global variables                                                            #
+###############################################################################
+
+DATA = {
+    'initialized': False,
+    'opacity': {
+        'focused': 1.0,
+        'inactive': 1.0
+        },
+    'variant': None,
+    'hide_bar': False,
+    'workspace_ignore': [],
+    'tree_resync': 30.0,
+    'coalesce_delay': 0.02,
+    'asyncio': False,
+    'polybar_ipc': '/tmp/polybar_mqueue.*',
+    'state_file': None,
+    'state_interval': 60.0,
+    'shutdown_timeout': 1.0,
+    'focus_history': 32,
+    'profile_dir': '/tmp',
+    'profile_interval': 0.005,
+    'workers': 1,
+    'echo_timeout': 0.5,
+    'dry_run': False
+    }
+I3DT_LAYOUT = dict()
+FOCUS = {'previous': None, 'current': None, 'history': dict()}
+TREE = {
+    'root': None,
+    'index': dict(),
+    'parents': dict(),
+    'cons': dict(),
+    'focused': None,
+    'workspace': None,
+    'dirty': True,
+    'synced': 0.0,
+    'hits': 0,
+    'syncs': 0,
+    'through': 0,
+    'prefetched': 0
+    }
+COALESCE = {'pending': dict(), 'timers': dict()}
+ROUND_TRIPS = {'command': 0, 'tree': 0, 'bytes': 0}
+METRICS = dict()
+PROFILE = {'events': 0, 'profile': None, 'path': None, 'sampler': None}
+OPACITY = {'applied': dict(), 'info': None, 'layouts': dict()}
+BAR = {'state': None, 'sink': None, 'queue': queue.Queue(), 'worker': None}
+STATE = {'version': 1, 'timer': None, 'written': None}
+ASYNC = {'loop': None, 'events': None, 'command': None, 'lock': None,
+         'stop': None, 'prefetch': None, 'requests': collections.deque(),
+         'stale': False, 'read': 0, 'handled': 0, 'sent': 0, 'replied': 0}
+CONTROL = {'server': None, 'inode': None, 'thread': None}
+LOG = {'queue': queue.Queue(), 'listener': None, 'ring': None}
+SIGNALS = {'read': None, 'write': None, 'thread': None}
+DISPATCH = {
+    'queues': dict(),
+    'ready': queue.Queue(),
+    'threads': [],
+    'depth': dict(),
+    'workspace': None,
+    'event': None,
+    'key': None,
+    'sequence': 0,
+    'current': 0,
+    'focused': 0
+    }
+ECHO = {'move': dict(), 'focus': [], 'deadline': 0.0,
+        'suppressed': {'move': 0, 'focus': 0}}
+BUFFER = {'depth': 0, 'chains': [], 'frames': [], 'messages': 0, 'early': 0}
+
+# Serializes the event handlers with the delayed reconciliation. The handlers
+# share the blocking connection, the tree mirror and the command buffer, so
+# they never run at the same time, also not for different workspaces.
+LOCK = threading.RLock()
+
+# Guards the workspace queues of the dispatched events.
+DISPATCH_LOCK = threading.Condition()
+
+# Guards the metric histograms, which are also updated outside the handlers.
+METRICS_LOCK = threading.Lock()
+
+# The frames of the metered calls that are running, per thread.
+CALLS = threading.local()
+
+# Commands that only change state that is reported back through window events
+# and therefore can be patched into the tree mirror.
+NON_STRUCTURAL = re.compile(
+    r'^(?:\[con_id=(\d+)\] )?(opacity \S+|focus(?: left| right| up| down)?|'
+    r'mark \S+|unmark(?: \S+)?)$')
+OPACITY_COMMAND = re.compile(r'^(?:\[con_id=\d+\] )?opacity \S+$')
+
+# The i3 IPC protocol as spoken by the event loop of the asynchronous mode.
+IPC_MAGIC = b'i3-ipc'
+IPC_COMMAND = 0
+IPC_SUBSCRIBE = 2
+IPC_GET_TREE = 4
+IPC_EVENTS = {0: ('workspace', i3ipc.WorkspaceEvent),
+              3: ('window', i3ipc.WindowEvent),
+              5: ('binding', i3ipc.BindingEvent),
+              7: ('tick', i3ipc.TickEvent)}
+
+# Temporary mark of the window a repositioned window is moved next to.
+REPOSITION_MARK = 'I3DT_TEMP'
+
+# Commands of the daemon that are echoed by window move and focus events.
+ECHO_COMMAND = re.compile(
+    r'^(?:\[con_id=(\d+)\] )?(focus|'
+    r'move (?:to mark \S+|left|right|up|down)|'
+    r'swap container with con_id (\d+))$')
+
+
+###############################################################################
+# Metrics                                                                     #
+###############################################################################
+
+class Histogram:
+    """A histogram of non-negative values in fixed memory.
+
+    The buckets grow by a factor of 2**(1/4), so the reported percentiles are
+    upper bounds within 19 % of the recorded values. Zero has a bucket of its
+    own.
+
+    Parameters
+    ----------
+    lowest : float
+        The upper bound of the first bucket above zero
+
+    """
+
+    __slots__ = ('lowest', 'counts', 'count', 'maximum')
+
+    FACTOR = 2 ** 0.25
+    SIZE = 100
+
+    def __init__(self, lowest):
+        self.lowest = lowest
+        self.counts = [0] * self.SIZE
+        self.count = 0
+        self.maximum = 0
+
+    def add(self, value):
+        """Count a value."""
+        index = 0
+        if value > self.lowest:
+            index = 1 + int(math.ceil(math.log(value / self.lowest,
+                                               self.FACTOR)))
+        elif value > 0:
+            index = 1
+        self.counts[min(index, self.SIZE - 1)] += 1
+        self.count += 1
+        self.maximum = max(self.maximum, value)
+
+    def percentile(self, fraction):
+        """Get the upper bound of a percentile, for example 0.95."""
+        rank = fraction * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if count and cumulative >= rank:
+                if index == 0:
+                    return 0
+                return min(self.lowest * self.FACTOR ** (index - 1),
+                           self.maximum)
+        return self.maximum
+
+
+def metered(function):
+    """Record the cost of every call of a handler or helper.
+
+    The wall time, the IPC round trips, the bytes sent and received over IPC
+    and the size of the tree mirror are kept in histograms per function name.
+    The round trips and bytes of the commands that a call buffered are
+    credited to it when the buffer is flushed.
+
+    """
+    name = function.__name__
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        frame = meter_enter(functools.partial(metrics_record, name))
+        trips = round_trips()
+        transferred = ROUND_TRIPS['bytes']
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            meter_exit(frame, {
+                'time_ms': (time.perf_counter() - start) * 1000.0,
+                'trips': round_trips() - trips,
+                'kbytes': (ROUND_TRIPS['bytes'] - transferred) / 1024.0,
+                'nodes': len(TREE['index'])})
+    return wrapper
+
+
+def meter_enter(record):
+    """Open the frame of a measured call on the stack of the thread.
+
+    Parameters
+    ----------
+    record : callable
+        Called with the sample of the call once it is complete
+
+    """
+    stack = getattr(CALLS, 'stack', None)
+    if stack is None:
+        stack = CALLS.stack = []
+    frame = {'record': record, 'sample': None, 'buffered': False}
+    stack.append(frame)
+    return frame
+
+
+def meter_exit(frame, sample):
+    """Close the frame of a measured call.
+
+    The sample is recorded right away, or when the commands the call
+    buffered are sent.
+
+    """
+    CALLS.stack.pop()
+    frame['sample'] = sample
+    if not frame['buffered']:
+        frame['record'](sample)
+
+
+def meter_buffered():
+    """Get the open frames that a buffered chain is not credited to yet."""
+    frames = [f for f in getattr(CALLS, 'stack', ()) if not f['buffered']]
+    for frame in frames:
+        frame['buffered'] = True
+    return frames
+
+
+def meter_credit(frames, credit):
+    """Credit the round trips of a flush to the calls that buffered it.
+
+    The calls that are still running count the flush themselves, the
+    samples of the others are completed and recorded.
+
+    Parameters
+    ----------
+    frames : list
+        The frames from meter_buffered()
+    credit : dict
+        The round trips, the command messages, the chained commands and the
+        bytes of the flush, added to the sample keys of the same name
+
+    """
+    for frame in frames:
+        frame['buffered'] = False
+        if frame['sample'] is None:
+            continue
+        for key, value in credit.items():
+            if key in frame['sample']:
+                frame['sample'][key] += value
+        frame['record'](frame['sample'])
+
+
+def metrics_record(name, sample):
+    """Add the sample of a call to the histograms of the function."""
+    with METRICS_LOCK:
+        if name not in METRICS:
+            METRICS[name] = {'time_ms': Histogram(0.01),
+                             'trips': Histogram(1),
+                             'kbytes': Histogram(0.1),
+                             'nodes': Histogram(1)}
+        for key, value in sample.items():
+            METRICS[name][key].add(value)
+
+
+def metrics_summary():
+    """Get the count, p50, p95, p99 and maximum of every metric.
+
+    The summary is a snapshot taken under the lock of the histograms, so it
+    can be serialized while the handlers keep recording.
+
+    """
+    summary = dict()
+    with METRICS_LOCK:
+        for name, metrics in sorted(METRICS.items()):
+            summary[name] = {'calls': metrics['time_ms'].count}
+            for key, histogram in metrics.items():
+                summary[name][key] = {
+                    'p50': histogram.percentile(0.50),
+                    'p95': histogram.percentile(0.95),
+                    'p99': histogram.percentile(0.99),
+                    'max': histogram.maximum
+                    }
+    return summary
+
+
+def metrics_dump(stream=None):
+    """Write the metrics as a table, to stderr by default."""
+    stream = stream or sys.stderr
+    columns = ['calls', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'trips_p95',
+               'kbytes_p95', 'nodes_max']
+    lines = ['{:<22}'.format('handler')
+             + ''.join('{:>11}'.format(c) for c in columns)]
+    for name, row in metrics_summary().items():
+        cells = [row['calls'], row['time_ms']['p50'], row['time_ms']['p95'],
+                 row['time_ms']['p99'], row['time_ms']['max'],
+                 row['trips']['p95'], row['kbytes']['p95'],
+                 row['nodes']['max']]
+        lines.append('{:<22}'.format(name) + '{:>11}'.format(cells[0])
+                     + ''.join('{:>11.3f}'.format(c) for c in cells[1:]))
+    queues = dispatch_depth()
+    if queues:
+        lines.append('\n{:<22}{:>11}{:>11}'.format('queue', 'depth', 'max'))
+    for name, gauge in queues.items():
+        lines.append('{:<22}{:>11}{:>11}'.format(name, gauge['depth'],
+                                                 gauge['max']))
+    lines.append('\nsuppressed echoes: {} move, {} focus'.format(
+        ECHO['suppressed']['move'], ECHO['suppressed']['focus']))
+    lines.append('command messages: {}, flushed early {}'.format(
+        BUFFER['messages'], BUFFER['early']))
+    lines.append('tree syncs: {}, requested ahead {}'.format(
+        TREE['syncs'], TREE['prefetched']))
+    stream.write('\n'.join(lines) + '\n')
+    stream.flush()
+
+
+###############################################################################
+# Profiler                                                                    #
+###############################################################################
+
+def profile_path(extension):
+    """Get a new path for a profile in the profile directory."""
+    return os.path.join(DATA['profile_dir'], 'i3ipc-dynamic-tiling-{}-{}.{}'
+                        .format(os.getpid(), time.strftime('%Y%m%d-%H%M%S'),
+                                extension))
+
+
+def profile_sample(duration, path):
+    """Sample the stacks of all threads and write them folded.
+
+    Every line of the output is a stack from the thread name to the innermost
+    frame separated by semicolons, followed by the number of samples, which
+    is the input format of flamegraph.pl, speedscope and inferno.
+
+    Parameters
+    ----------
+    duration : float
+        Seconds to sample
+    path : str
+        The output file
+
+    """
+    stacks = collections.Counter()
+    sampler = threading.get_ident()
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == sampler:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append('{}:{}'.format(
+                    os.path.basename(frame.f_code.co_filename),
+                    frame.f_code.co_name))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            stacks[';'.join(reversed(stack))] += 1
+        time.sleep(DATA['profile_interval'])
+    try:
+        with open(path, 'w') as stream:
+            for stack, count in sorted(stacks.items()):
+                stream.write('{} {}\n'.format(stack, count))
+    except OSError as error:
+        logging.error('Profile::Sample::%s', error)
+        return
+    finally:
+        PROFILE['sampler'] = None
+    logging.info('Profile::Sample::%s', path)
+
+
+def profile_start(mode, amount):
+    """Start the stack sampler or the profile of the next events.
+
+    Nothing is measured while no profile is running, the sampler is a thread
+    of its own and the profiled events only cost a check of the counter.
+
+    Parameters
+    ----------
+    mode : str
+        'sample' for the stack sampler or 'events' for cProfile
+    amount : float
+        Seconds to sample or the number of events to profile
+
+    Returns
+    -------
+    str
+        The file the profile is written to
+
+    """
+    if mode == 'sample':
+        if PROFILE['sampler'] is not None:
+            raise ValueError('The sampler is already running')
+        path = profile_path('folded')
+        PROFILE['sampler'] = threading.Thread(
+            target=profile_sample, args=(float(amount), path), daemon=True)
+        PROFILE['sampler'].start()
+    elif mode == 'events':
+        if int(amount) < 1:
+            raise ValueError('Invalid number of events: {}'.format(amount))
+        path = profile_path('prof')
+        with LOCK:
+            PROFILE.update(events=int(amount), profile=cProfile.Profile(),
+                           path=path)
+    else:
+        raise ValueError('Unknown profile mode: {}'.format(mode))
+    logging.info('Profile::%s::%s', mode.title(), amount)
+    return path
+
+
+def profile_event(handler, ipc, event):
+    """Run an event handler under cProfile and write the profile when done."""
+    try:
+        PROFILE['profile'].runcall(handler, ipc, event)
+    finally:
+        PROFILE['events'] -= 1
+        if not PROFILE['events']:
+            try:
+                PROFILE['profile'].dump_stats(PROFILE['path'])
+                logging.info('Profile::Events::%s', PROFILE['path'])
+            except OSError as error:
+                logging.error('Profile::Events::%s', error)
+            PROFILE['profile'] = None
+
+
+###############################################################################
+# Tree mirror                                                                 #
+###############################################################################
+
+def tree_walk(node):
+    """Iterate over a raw tree node and all its descendants."""
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        yield node
+        stack.extend(node.get('floating_nodes', []))
+        stack.extend(node.get('nodes', []))
+
+
+def tree_index(node, parent=None):
+    """Index a raw tree node and all its descendants by id."""
+    TREE['parents'][node['id']] = parent
+    for dsc in tree_walk(node):
+        TREE['index'][dsc['id']] = dsc
+        for child in dsc.get('nodes', []) + dsc.get('floating_nodes', []):
+            TREE['parents'][child['id']] = dsc
+        if dsc.get('focused'):
+            TREE['focused'] = dsc['id']
+
+
+def tree_workspace(con_id):
+    """Find the raw workspace node of a container in the mirror."""
+    node = TREE['index'].get(con_id)
+    while node is not None and node.get('type') != 'workspace':
+        node = TREE['parents'].get(node['id'])
+    return node
+
+
+def tree_workspaces(ipc, names=None):
+    """Get the raw workspace nodes from the tree mirror.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection, used to resync a stale mirror
+    names : iterable, optional
+        The names of the workspaces (default all but the internal ones)
+
+    """
+    command_flush(ipc)
+    if TREE['dirty']:
+        tree_sync(ipc)
+    return [n for n in TREE['index'].values()
+            if n.get('type') == 'workspace' and not n['name'].startswith('__')
+            and (names is None or n['name'] in names)]
+
+
+def tree_fetch(ipc):
+    """Get the raw tree and the size of the reply in bytes.
+
+    The private message interface of i3ipc returns the undecoded reply. When
+    it is missing or changed, the tree is taken from the public get_tree(),
+    which decodes the reply to containers first, and the size is unknown.
+
+    """
+    if MessageType is not None:
+        try:
+            reply = ipc._message(MessageType.GET_TREE, '')
+        except (AttributeError, TypeError):
+            pass
+        else:
+            return json_loads(reply), len(reply)
+    return ipc.get_tree().ipc_data, 0
+
+
+def tree_sync(ipc):
+    """Replace the tree mirror with a fresh tree from the window manager.
+
+    The reply is only decoded to plain dictionaries, the i3ipc containers are
+    created on demand for a single workspace by tree_focused_workspace(). In
+    the asynchronous mode a tree that was requested ahead by the event loop
+    is used when it is still current.
+
+    """
+    command_flush(ipc)
+    logging.debug('Tree::Sync')
+    prefetched = async_prefetched() if ASYNC['loop'] is not None else None
+    if prefetched is None:
+        TREE['root'], size = tree_fetch(ipc)
+    else:
+        reply, TREE['through'] = prefetched
+        TREE['root'], size = json_loads(reply), len(reply)
+        TREE['prefetched'] += 1
+    ROUND_TRIPS['tree'] += 1
+    ROUND_TRIPS['bytes'] += size
+    TREE['index'] = dict()
+    TREE['parents'] = dict()
+    TREE['cons'] = dict()
+    TREE['focused'] = None
+    tree_index(TREE['root'])
+    workspace = tree_workspace(TREE['focused'])
+    if workspace is not None:
+        TREE['workspace'] = workspace['name']
+    TREE['dirty'] = False
+    TREE['synced'] = time.monotonic()
+    TREE['syncs'] += 1
+    return TREE['root']
+
+
+def tree_invalidate():
+    """Force a resync of the tree mirror on the next access.
+
+    The workspace information cached for the opacity is dropped as well.
+
+    """
+    TREE['dirty'] = True
+    OPACITY['info'] = None
+
+
+def tree_focused_workspace(ipc):
+    """Get the focused workspace from the mirror, resyncing it when needed.
+
+    Only the subtree of the workspace is converted to i3ipc containers and the
+    result is cached until the mirror changes.
+
+    """
+    command_flush(ipc)
+    expired = time.monotonic() - TREE['synced'] > DATA['tree_resync']
+    if TREE['root'] is None or TREE['dirty'] or expired:
+        tree_sync(ipc)
+    else:
+        TREE['hits'] += 1
+    node = tree_workspace(TREE['focused'])
+    if node is None:
+        return None
+    if node['id'] not in TREE['cons']:
+        TREE['cons'][node['id']] = i3ipc.Con(node, None, ipc)
+    return TREE['cons'][node['id']]
+
+
+def tree_patchable(commands):
+    """Check if the effect of the commands can be patched into the mirror.
+
+    Focus changes are only reported for windows and focusing a split container
+    therefore invalidates the mirror, a directional focus ends on a window.
+
+    """
+    for cmd in commands:
+        match = NON_STRUCTURAL.match(cmd.strip())
+        if not match:
+            return False
+        if match.group(2) == 'focus':
+            node = TREE['index'].get(int(match.group(1) or 0))
+            if node is None or node.get('nodes'):
+                return False
+    return True
+
+
+def tree_set_focus(node):
+    """Move the focus in the mirror to the specified node."""
+    previous = TREE['index'].get(TREE['focused'])
+    if previous is not None:
+        previous['focused'] = False
+    node['focused'] = True
+    TREE['focused'] = node['id']
+    child = node
+    parent = TREE['parents'].get(child['id'])
+    while parent is not None:
+        focus = parent.get('focus')
+        if focus is not None:
+            if child['id'] in focus:
+                focus.remove(child['id'])
+            focus.insert(0, child['id'])
+        child = parent
+        parent = TREE['parents'].get(child['id'])
+
+
+def tree_on_window(ipc, event):
+    """Patch the tree mirror from a window event.
+
+    Structural changes (new, close, move and floating) cannot be derived from
+    the event payload and invalidate the mirror instead. Events that are
+    already reflected by a tree requested ahead in the asynchronous mode are
+    skipped.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    event : i3ipc.WindowEvent
+        An i3ipc window event
+
+    """
+    # pylint: disable=unused-argument
+    if async_reflected():
+        return
+    if event.change == 'focus' and dispatch_overtaken():
+        tree_invalidate()
+        return
+    if event.change == 'move' and echo_expected(event):
+        # The mirror was invalidated when the command was sent.
+        return
+    if TREE['dirty'] or event.change in ['new', 'close', 'move', 'floating']:
+        tree_invalidate()
+        return
+    window = event.ipc_data['container']
+    node = TREE['index'].get(window['id'])
+    if node is None:
+        logging.debug('Tree::Mismatch::%s', window['id'])
+        tree_invalidate()
+        return
+    TREE['cons'].clear()
+    if event.change == 'focus':
+        tree_set_focus(node)
+        node['fullscreen_mode'] = window.get('fullscreen_mode')
+    elif event.change == 'mark':
+        node['marks'] = window.get('marks', [])
+    elif event.change == 'title':
+        node['name'] = window.get('name')
+    elif event.change == 'fullscreen_mode':
+        node['fullscreen_mode'] = window.get('fullscreen_mode')
+
+
+def tree_on_workspace(ipc, event):
+    """Patch the tree mirror from a workspace event.
+
+    The focus event carries the complete subtree of the focused workspace which
+    replaces the mirrored workspace.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    event : i3ipc.WorkspaceEvent
+        An i3ipc workspace event
+
+    """
+    # pylint: disable=unused-argument
+    if async_reflected():
+        return
+    if event.change == 'focus' and dispatch_overtaken():
+        tree_invalidate()
+        return
+    if event.change == 'focus' and event.current is not None:
+        TREE['workspace'] = event.current.name
+    if TREE['dirty'] or event.change == 'urgent':
+        return
+    if event.change != 'focus' or event.current is None:
+        tree_invalidate()
+        return
+    current = event.ipc_data['current']
+    old = TREE['index'].get(current['id'])
+    parent = TREE['parents'].get(current['id'])
+    if old is None or parent is None:
+        logging.debug('Tree::Mismatch::%s', current['name'])
+        tree_invalidate()
+        return
+    TREE['cons'].clear()
+    focused = TREE['index'].get(TREE['focused'])
+    if focused is not None:
+        focused['focused'] = False
+    TREE['focused'] = None
+    for dsc in tree_walk(old):
+        TREE['index'].pop(dsc['id'], None)
+        TREE['parents'].pop(dsc['id'], None)
+    nodes = parent['nodes']
+    nodes[next(i for i, n in enumerate(nodes) if n is old)] = current
+    tree_index(current, parent)
+    tree_set_focus(TREE['index'].get(TREE['focused'], current))
+
+
+def tree_on_binding(ipc, event):
+    """Invalidate the tree mirror after a binding that changes the tree.
+
+    Layout and split changes are not reported by any other event.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    event : i3ipc.BindingEvent
+        An i3ipc binding event
+
+    """
+    # pylint: disable=unused-argument
+    if async_reflected():
+        return
+    command = event.binding.command
+    if not command.startswith('nop') and \
+            not tree_patchable(command.split(';')):
+        tree_invalidate()
+
+
+###############################################################################
+# Command buffer                                                              #
+###############################################################################
+
+def buffered(function):
+    """Collect the commands of a handler and send them when it returns.
+
+    The buffer is scoped to the outermost buffered call, which holds the lock
+    while it runs, so the nested handlers and helpers share it. The commands
+    are sent when the outermost call returns, also when it fails. The event
+    handlers are buffered inside metered(), so their metrics include the
+    commands sent for them.
+
+    """
+    @functools.wraps(function)
+    def wrapper(ipc, *args, **kwargs):
+        with LOCK:
+            BUFFER['depth'] += 1
+            try:
+                return function(ipc, *args, **kwargs)
+            finally:
+                BUFFER['depth'] -= 1
+                if not BUFFER['depth']:
+                    command_flush(ipc)
+    return wrapper
+
+
+def command_flush(ipc):
+    """Send the buffered commands.
+
+    The buffer is flushed before the tree is read, the tree mirror must not
+    miss the effect of the commands that were not sent yet.
+
+    The chains of the execute_commands() calls are joined into one message,
+    whose round trips are credited to the metered calls that buffered them.
+    Both i3 and sway run the rest of a chain after a command that fails, for
+    example on a criteria without a matching window, sway only stops at a
+    command it cannot parse.
+
+    """
+    if not BUFFER['chains']:
+        return
+    chains, BUFFER['chains'] = BUFFER['chains'], []
+    frames, BUFFER['frames'] = BUFFER['frames'], []
+    if BUFFER['depth']:
+        BUFFER['early'] += 1
+    chain = [cmd for cmds in chains for cmd in cmds]
+    trips, transferred = round_trips(), ROUND_TRIPS['bytes']
+    try:
+        command_send(ipc, chain)
+    finally:
+        trips = round_trips() - trips
+        transferred = ROUND_TRIPS['bytes'] - transferred
+        # The bytes under the keys of both the metrics and the replay.
+        meter_credit(frames, {'trips': trips, 'command': trips,
+                              'chained': len(chain), 'bytes': transferred,
+                              'kbytes': transferred / 1024.0})
+
+
+def command_fetch(ipc, payload):
+    """Send a command and get the replies and the size of the reply in bytes.
+
+    As in tree_fetch(), the public command() is used when the private
+    message interface of i3ipc is missing or changed, and the size is
+    unknown.
+
+    """
+    if MessageType is not None:
+        try:
+            reply = ipc._message(MessageType.COMMAND, payload)
+        except (AttributeError, TypeError):
+            pass
+        else:
+            data = json_loads(reply) if reply else []
+            return [i3ipc.CommandReply(x) for x in data], len(reply)
+    return ipc.command(payload), 0
+
+
+@metered
+def command_send(ipc, chain):
+    """Send a chain of commands to the window manager.
+
+    In the asynchronous mode the opacity commands are sent from the event
+    loop without waiting for the reply. The tree mirror and the expected
+    echoes are updated by execute_commands() when the chain is issued.
+
+    """
+    if ASYNC['loop'] is not None:
+        opacity = [x for x in chain if OPACITY_COMMAND.match(x)]
+        if opacity:
+            ROUND_TRIPS['command'] += 1
+            run_async(async_command('; '.join(opacity)))
+            chain = [x for x in chain if not OPACITY_COMMAND.match(x)]
+            if not chain:
+                return
+    payload = '; '.join(chain)
+    ROUND_TRIPS['command'] += 1
+    BUFFER['messages'] += 1
+    ASYNC['sent'] += 1
+    try:
+        reply, size = command_fetch(ipc, payload)
+    finally:
+        ASYNC['replied'] += 1
+    ROUND_TRIPS['bytes'] += len(payload.encode('utf-8')) + size
+    debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+    for ind, cmd in enumerate(chain):
+        if ind >= len(reply):
+            break
+        if debug:
+            logging.debug('+ %s => %s', cmd, reply[ind].ipc_data)
+        if not reply[ind].success:
+            logging.error(reply[ind].error)
+
+
+###############################################################################
+# Event coalescing                                                            #
+###############################################################################
+
+def locked(handler):
+    """Serialize an event handler with the other handlers.
+
+    The handler is profiled while a profile of the next events is running.
+
+    """
+    def wrapper(ipc, event):
+        with LOCK:
+            if PROFILE['events']:
+                profile_event(handler, ipc, event)
+            else:
+                handler(ipc, event)
+    return wrapper
+
+
+def event_workspace(event):
+    """Find the name of the workspace of a window event in the mirror.
+
+    Windows that are not in the mirror yet, for example new windows, are
+    assumed to be on the focused workspace.
+
+    """
+    workspace = tree_workspace(event.container.id)
+    return workspace['name'] if workspace is not None else TREE['workspace']
+
+
+def coalesce(ipc, event, adopt=False):
+    """Queue a structural window event for a delayed reconciliation.
+
+    Events for the same workspace that arrive within the coalesce delay are
+    handled by a single reconciliation. The events of windows that are not
+    in the mirror yet, for example new windows, are queued without a
+    workspace and sorted out when they are handled.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    event : i3ipc.WindowEvent
+        An i3ipc window event
+    adopt : bool, optional
+        Move the window of the event into the split containers (default
+        False)
+
+    """
+    workspace = tree_workspace(event.container.id)
+    name = workspace['name'] if workspace is not None else None
+    pending = COALESCE['pending'].setdefault(name, set())
+    if adopt:
+        pending.add(event.container.id)
+    if DATA['coalesce_delay'] <= 0:
+        coalesce_flush(ipc, name)
+    elif name not in COALESCE['timers']:
+        timer = threading.Timer(DATA['coalesce_delay'], coalesce_flush,
+                                (ipc, name))
+        timer.daemon = True
+        COALESCE['timers'][name] = timer
+        timer.start()
+
+
+@metered
+@buffered
+def coalesce_flush(ipc, name):
+    """Reconcile the queued events of a workspace.
+
+    The focused workspace is reconciled with reconcile(), and the workspaces
+    in the background with reconcile_workspaces(), which does not move the
+    focus. Repairs that need the focus are deferred until the workspace is
+    focused again.
+
+    """
+    with LOCK:
+        timer = COALESCE['timers'].pop(name, None)
+        if timer is not None:
+            timer.cancel()
+        if name not in COALESCE['pending']:
+            return
+        info = get_workspace_info(ipc)
+        if name is None:
+            # Sort the windows by the workspace they turned up on.
+            adopt = COALESCE['pending'].pop(None)
+            names = set()
+            missing = False
+            for cid in adopt:
+                workspace = tree_workspace(cid)
+                if workspace is None:
+                    missing = True
+                    continue
+                names.add(workspace['name'])
+                COALESCE['pending'].setdefault(workspace['name'],
+                                               set()).add(cid)
+            # Windows that are gone, or not placed yet, are checked on the
+            # focused workspace.
+            if missing or not names:
+                names.add(info.name)
+            for other in sorted(names, key=lambda n: n == info.name):
+                COALESCE['pending'].setdefault(other, set())
+                coalesce_flush(ipc, other)
+            return
+        if info.name != name:
+            adopt = COALESCE['pending'].pop(name)
+            for other in reconcile_workspaces(ipc, [name], adopt):
+                logging.debug('Workspace::Reconcile::Deferred::%s', other)
+                COALESCE['pending'][other] = adopt
+            return
+        reconcile(ipc, COALESCE['pending'].pop(name))
+
+
+def coalesce_flush_all(ipc):
+    """Reconcile all queued events without waiting for the delay."""
+    for name in list(COALESCE['pending']):
+        coalesce_flush(ipc, name)
 
-# logging.basicConfig(
-#         format='%(asctime)s %(levelname)s: %(message)s',
-#         level=log_level_numeric)
 
-logging.basicConfig(
-        format='%(asctime)s %(levelname)s: %(message)s',
-        level=0)
+###############################################################################
+# Event dispatch                                                              #
+###############################################################################
+
+def dispatch_key(event):
+    """Find the workspace queue of an event on the thread reading the events.
+
+    Window events go to the workspace of the window in the mirror, workspace
+    events to their workspace, and bindings and windows that are not in the
+    mirror yet to the workspace focused when the event was read. The mirror
+    is read without the lock, a stale answer only picks another queue.
+
+    Every event is numbered once, the handlers subscribed to the same event
+    get the same queue and number.
+
+    """
+    if event is DISPATCH['event']:
+        return DISPATCH['key']
+    key = DISPATCH['workspace']
+    current = getattr(event, 'current', None)
+    container = getattr(event, 'container', None)
+    if current is not None:
+        key = current.name
+        if event.change == 'focus':
+            DISPATCH['workspace'] = key
+    elif container is not None:
+        workspace = tree_workspace(container.id)
+        if workspace is not None:
+            key = workspace['name']
+    DISPATCH['sequence'] += 1
+    DISPATCH['event'] = event
+    DISPATCH['key'] = key
+    return key
+
+
+def dispatched(handler):
+    """Queue an event handler on the workspace queue of the event.
+
+    The events of a workspace are handled in order while the worker threads
+    drain the queues of other workspaces. The handlers still take the lock
+    and run one at a time, the workers only keep the thread reading the
+    events from waiting on a slow handler. Without workers the handler runs
+    right away on the thread reading the events.
+
+    """
+    handler = locked(handler)
+
+    def wrapper(ipc, event):
+        if not DISPATCH['threads']:
+            handler(ipc, event)
+            return
+        key = dispatch_key(event)
+        with DISPATCH_LOCK:
+            pending = DISPATCH['queues'].get(key)
+            if pending is None:
+                pending = DISPATCH['queues'][key] = collections.deque()
+                DISPATCH['ready'].put(key)
+            pending.append((handler, event, DISPATCH['sequence']))
+            DISPATCH['depth'][key] = max(DISPATCH['depth'].get(key, 0),
+                                         len(pending))
+    return wrapper
+
+
+def dispatch_worker(ipc):
+    """Handle the events of the ready workspace queues.
+
+    A queue is owned by one worker from the moment it is ready until it is
+    empty. The worker handles one event and puts the queue back in line, so a
+    burst on one workspace does not starve the others.
+
+    """
+    while True:
+        key = DISPATCH['ready'].get()
+        if key is None:
+            return
+        with DISPATCH_LOCK:
+            pending = DISPATCH['queues'].get(key)
+            if not pending:
+                continue
+            handler, event, sequence = pending.popleft()
+        try:
+            with LOCK:
+                DISPATCH['current'] = sequence
+                handler(ipc, event)
+        except Exception:  # pylint: disable=broad-except
+            logging.exception('Dispatch::Error::%s', key)
+        with DISPATCH_LOCK:
+            if pending:
+                DISPATCH['ready'].put(key)
+            elif DISPATCH['queues'].get(key) is pending:
+                del DISPATCH['queues'][key]
+                DISPATCH_LOCK.notify_all()
+
+
+def dispatch_overtaken():
+    """Check if the focus event being handled is older than a handled one.
+
+    Queues of different workspaces are drained independently, so a focus
+    event can be handled after a newer one of another workspace. The newest
+    focus is kept, the caller skips the older event.
+
+    """
+    if DISPATCH['current'] < DISPATCH['focused']:
+        logging.debug('Dispatch::Overtaken::%d', DISPATCH['current'])
+        return True
+    DISPATCH['focused'] = DISPATCH['current']
+    return False
+
+
+def dispatch_depth():
+    """Get the current and the largest depth of every workspace queue."""
+    with DISPATCH_LOCK:
+        return {key: {'depth': len(DISPATCH['queues'].get(key, ())),
+                      'max': depth}
+                for key, depth in sorted(DISPATCH['depth'].items())}
+
+
+def dispatch_wait(timeout=None):
+    """Wait until all queued events are handled.
+
+    Returns
+    -------
+    bool
+        False if the timeout expired first, True otherwise.
+
+    """
+    with DISPATCH_LOCK:
+        return DISPATCH_LOCK.wait_for(lambda: not DISPATCH['queues'],
+                                      timeout)
+
+
+def dispatch_start(ipc):
+    """Start the worker threads that handle the dispatched events.
+
+    In the asynchronous mode the events are queued by the event loop and no
+    workers are started.
+
+    """
+    if DISPATCH['threads'] or ASYNC['loop'] is not None:
+        return
+    DISPATCH['workspace'] = TREE['workspace']
+    for _ in range(DATA['workers']):
+        thread = threading.Thread(target=dispatch_worker, args=(ipc,),
+                                  daemon=True)
+        DISPATCH['threads'].append(thread)
+        thread.start()
+
+
+def dispatch_stop():
+    """Stop the worker threads, the events still queued are dropped."""
+    with DISPATCH_LOCK:
+        DISPATCH['queues'].clear()
+        DISPATCH_LOCK.notify_all()
+    for _ in DISPATCH['threads']:
+        DISPATCH['ready'].put(None)
+    DISPATCH['threads'] = []
+
+
+###############################################################################
+# Echo suppression                                                            #
+###############################################################################
+
+def echo_expect(chain, start=0):
+    """Record the window events that a chain of commands is going to cause.
+
+    Every window that is moved or swapped is echoed by a move event, which
+    needs no reconciliation as the daemon placed the window itself. Of the
+    windows focused by the chain only the last one stays focused, the focus
+    events of the others, sent by sway, are transient and skipped. The
+    expectations expire after the echo timeout, so echoes that are never
+    sent, for example by i3 for the transient focus, are forgotten.
+
+    Parameters
+    ----------
+    chain : list
+        The commands, as sent in a single message
+    start : int, optional
+        The index of the first command whose moves are recorded, the earlier
+        commands are already recorded and only followed for the focus
+        (default 0)
+
+    """
+    deadline = time.monotonic() + DATA['echo_timeout']
+    subject = FOCUS['current']
+    focused = []
+    for index, cmd in enumerate(chain):
+        match = ECHO_COMMAND.match(cmd.strip())
+        if match is None:
+            if cmd.strip().startswith('focus'):
+                subject = None
+                focused.append(None)
+            continue
+        target = int(match.group(1)) if match.group(1) else subject
+        if match.group(2) == 'focus':
+            subject = target
+            focused.append(target)
+            continue
+        if index < start:
+            continue
+        for cid in [target, match.group(3)]:
+            if cid is not None:
+                count = ECHO['move'].get(int(cid), (0, 0))[0]
+                ECHO['move'][int(cid)] = (count + 1, deadline)
+    transient = []
+    previous = FOCUS['current']
+    for cid in focused[:-1]:
+        if cid is None:
+            break
+        node = TREE['index'].get(cid)
+        if cid != previous and (node is None or not node.get('nodes')):
+            transient.append(cid)
+        previous = cid
+    if transient:
+        ECHO['focus'] = transient
+        ECHO['deadline'] = deadline
+
+
+def echo_expected(event):
+    """Check if a window move event is expected, without consuming it."""
+    count, deadline = ECHO['move'].get(event.container.id, (0, 0))
+    return count > 0 and deadline > time.monotonic()
+
+
+def echo_suppressed(event):
+    """Check if a window move or focus event is an echo of own commands.
+
+    Focus events are matched in order, any other focus event drops the
+    remaining expectations.
+
+    Parameters
+    ----------
+    event : i3ipc.WindowEvent
+        An i3ipc window event
+
+    Returns
+    -------
+    bool
+        True if the event is an echo that is not handled, False otherwise.
+
+    """
+    cid = event.container.id
+    now = time.monotonic()
+    if event.change == 'move':
+        count, deadline = ECHO['move'].pop(cid, (0, 0))
+        if count > 1 and deadline > now:
+            ECHO['move'][cid] = (count - 1, deadline)
+        suppressed = count > 0 and deadline > now
+    else:
+        suppressed = bool(ECHO['focus']) and ECHO['focus'][0] == cid \
+            and ECHO['deadline'] > now
+        if suppressed:
+            ECHO['focus'].pop(0)
+        else:
+            ECHO['focus'] = []
+    if suppressed:
+        logging.debug('Window::Echo::%s::%s', event.change.title(), cid)
+        ECHO['suppressed'][event.change] += 1
+    return suppressed
+
+
+###############################################################################
+# Asynchronous mode                                                           #
+###############################################################################
+
+def async_pack(message_type, payload=''):
+    """Pack a message of the i3 IPC protocol."""
+    data = payload.encode('utf-8')
+    return IPC_MAGIC + struct.pack('<II', len(data), message_type) + data
+
+
+async def async_receive(reader):
+    """Read one complete message of the i3 IPC protocol.
+
+    The header and the payload are read until all their bytes arrived, a
+    large tree or workspace event spans many reads of the socket.
+
+    Returns
+    -------
+    tuple
+        The message type and the raw payload.
+
+    """
+    header = await reader.readexactly(len(IPC_MAGIC) + 8)
+    if header[:len(IPC_MAGIC)] != IPC_MAGIC:
+        raise ValueError('Invalid IPC message')
+    length, message_type = struct.unpack('<II', header[len(IPC_MAGIC):])
+    return message_type, await reader.readexactly(length)
+
+
+async def async_command(commands):
+    """Send a chain of commands from the event loop."""
+    async with ASYNC['lock']:
+        reader, writer = ASYNC['command']
+        writer.write(async_pack(IPC_COMMAND, commands))
+        await writer.drain()
+        _, payload = await async_receive(reader)
+    ROUND_TRIPS['bytes'] += len(commands.encode('utf-8')) + len(payload)
+    reply = json_loads(payload)
+    logging.debug('+ %s => %s', commands, reply)
+    for result in reply:
+        if not result.get('success'):
+            logging.error(result.get('error'))
+
+
+def async_event(ipc, message_type, payload):
+    """Decode an event read by the event loop into an i3ipc event."""
+    kind, cls = IPC_EVENTS.get(message_type & 0x7f, (None, None))
+    if kind is None:
+        return None, None
+    data = json_loads(payload)
+    if kind in ['window', 'workspace']:
+        return kind, cls(data, ipc)
+    return kind, cls(data)
+
+
+def async_prefetch(kind, event):
+    """Request the tree for the next handler on the event connection.
+
+    The tree is requested on reading an event whose handler reads the tree,
+    a binding or a focus change, when the mirror is stale or is made stale
+    by an event read earlier, while the handlers of the earlier events still
+    run. The reply is read in order with the events, so it reflects exactly
+    the events read before it. It is not requested while a command of the
+    handlers is in flight, as it could be answered before the command is
+    done.
+
+    """
+    change = getattr(event, 'change', None)
+    if (kind == 'window' and change in ['new', 'close', 'move', 'floating']) \
+            or (kind == 'workspace' and change not in ['focus', 'urgent']) \
+            or (kind == 'binding' and
+                not event.binding.command.startswith('nop')):
+        ASYNC['stale'] = True
+    reads = kind == 'binding' or (kind == 'workspace' and change == 'focus') \
+        or (kind == 'window' and change == 'focus' and
+            DATA['variant'] == 'sway')
+    if not reads or not (ASYNC['stale'] or TREE['dirty']):
+        return
+    if ASYNC['requests'] or ASYNC['sent'] != ASYNC['replied']:
+        return
+    ASYNC['stale'] = False
+    ASYNC['prefetch'] = {'future': concurrent.futures.Future(),
+                         'sent': ASYNC['sent'], 'used': False}
+    ASYNC['requests'].append(ASYNC['prefetch'])
+    ASYNC['events'][1].write(async_pack(IPC_GET_TREE))
+
+
+def async_prefetched():
+    """Get the tree requested by async_prefetch() if it is still current.
+
+    The tree is current if no command was sent since it was requested and
+    no later event than the ones it reflects is handled yet. The events it
+    already reflects skip the mirror updates once it is installed.
+
+    Returns
+    -------
+    tuple
+        The raw tree and the number of the last event it reflects, or None
+        if the tree has to be fetched.
+
+    """
+    prefetch = ASYNC['prefetch']
+    if prefetch is None or prefetch['used'] or \
+            prefetch['sent'] != ASYNC['sent']:
+        return None
+    try:
+        reply, through = prefetch['future'].result()
+    except concurrent.futures.CancelledError:
+        return None
+    if ASYNC['handled'] > through:
+        return None
+    prefetch['used'] = True
+    return reply, through
+
+
+def async_reflected():
+    """Check if the event being handled is reflected by the mirror."""
+    return ASYNC['loop'] is not None and ASYNC['handled'] <= TREE['through']
+
+
+def run_async(coroutine):
+    """Schedule a coroutine on the event loop without waiting for it."""
+    return asyncio.run_coroutine_threadsafe(coroutine, ASYNC['loop'])
+
+
+def async_quit():
+    """Stop the event loop of the asynchronous mode."""
+    ASYNC['loop'].call_soon_threadsafe(ASYNC['stop'].set)
+
+
+async def main_async(ipc, subscriptions=None):
+    """Read the events on the event loop and overlap the replies.
+
+    The events are read on a connection of the event loop and passed in
+    order, one at a time, in a worker thread to the handlers, which use the
+    blocking connection, so the handlers keep the semantics of the default
+    mode; the events are queued by the loop and the dispatch workers are not
+    used. While a handler runs, the loop reads the next events and requests
+    the tree that the handler of the next queued event is going to read, the
+    opacity commands are sent from the loop without waiting for the reply,
+    and polybar is notified by its own thread.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    subscriptions : list, optional
+        Additional (event, handler) pairs to subscribe
+
+    """
+    loop = asyncio.get_running_loop()
+    events = await asyncio.open_unix_connection(ipc.socket_path)
+    command = await asyncio.open_unix_connection(ipc.socket_path)
+    ASYNC.update(loop=loop, events=events, command=command,
+                 lock=asyncio.Lock(), stop=asyncio.Event(), prefetch=None,
+                 requests=collections.deque(), stale=False, read=0,
+                 handled=0)
+    handlers = []
+    queued = asyncio.Queue()
+
+    def on(event, handler):
+        handlers.append((Event(event).value, handler))
+
+    subscribe(ipc, on)
+    for event, handler in subscriptions or []:
+        on(event, handler)
+    kinds = sorted({name.split('::')[0] for name, _ in handlers})
+    events[1].write(async_pack(IPC_SUBSCRIBE, json.dumps(kinds)))
+    await events[1].drain()
+    await async_receive(events[0])
+
+    async def read():
+        while True:
+            message_type, payload = await async_receive(events[0])
+            if message_type == IPC_GET_TREE:
+                ASYNC['requests'].popleft()['future'].set_result(
+                    (payload, ASYNC['read']))
+                continue
+            kind, event = async_event(ipc, message_type, payload)
+            if event is None:
+                continue
+            ASYNC['read'] += 1
+            names = [kind, '{}::{}'.format(kind, getattr(event, 'change',
+                                                         None))]
+            for name, handler in handlers:
+                if name in names:
+                    queued.put_nowait((handler, event, ASYNC['read']))
+            async_prefetch(kind, event)
+
+    async def pump():
+        with concurrent.futures.ThreadPoolExecutor(1) as worker:
+            while True:
+                handler, event, sequence = await queued.get()
+                ASYNC['handled'] = sequence
+                await loop.run_in_executor(worker, handler, ipc, event)
+
+    tasks = [asyncio.ensure_future(read()), asyncio.ensure_future(pump()),
+             asyncio.ensure_future(ASYNC['stop'].wait())]
+    try:
+        done, _ = await asyncio.wait(tasks,
+                                     return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if not task.cancelled() and isinstance(
+                    task.exception(), asyncio.IncompleteReadError):
+                logging.info('IPC::Closed')
+            else:
+                task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        for request in ASYNC['requests']:
+            request['future'].cancel()
+        for _, writer in [events, command]:
+            writer.close()
+        ASYNC.update(loop=None, events=None, command=None, lock=None,
+                     stop=None, prefetch=None, requests=collections.deque())
+
+
+###############################################################################
+# Polybar                                                                     #
+###############################################################################
+
+def polybar_sink(action):
+    """Send a command to all running polybar instances.
+
+    The command is written to the IPC FIFOs of polybar, and polybar-msg is
+    used when there are none, as with the IPC sockets of polybar 3.6.
+
+    Parameters
+    ----------
+    action : str
+        The polybar command, 'show' or 'hide'
+
+    """
+    fifos = glob.glob(DATA['polybar_ipc'])
+    for path in fifos:
+        try:
+            fifo = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError as error:
+            # No polybar is reading, for example a stale FIFO.
+            if error.errno not in [errno.ENXIO, errno.ENOENT]:
+                raise
+            continue
+        try:
+            os.write(fifo, 'cmd:{}\n'.format(action).encode())
+        finally:
+            os.close(fifo)
+    if not fifos:
+        subprocess.run(['polybar-msg', 'cmd', action], check=False,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def polybar_worker():
+    """Pass the queued polybar commands to the sink."""
+    while True:
+        action = BAR['queue'].get()
+        try:
+            (BAR['sink'] or polybar_sink)(action)
+        except (OSError, subprocess.SubprocessError) as error:
+            logging.error('Polybar::%s::%s', action.title(), error)
+        finally:
+            BAR['queue'].task_done()
+
+
+def polybar(action):
+    """Show or hide the polybar if enabled.
+
+    Only changes of the state are sent, from a background thread so that the
+    event handlers never wait for polybar.
+
+    Parameters
+    ----------
+    action : str
+        The polybar command, 'show' or 'hide'
+
+    """
+    if not DATA['hide_bar'] or BAR['state'] == action:
+        return
+    BAR['state'] = action
+    if BAR['worker'] is None:
+        BAR['worker'] = threading.Thread(target=polybar_worker, daemon=True)
+        BAR['worker'].start()
+    logging.debug('Polybar::%s', action.title())
+    BAR['queue'].put(action)
+
+
+###############################################################################
+# State snapshot                                                              #
+###############################################################################
+
+def state_marks():
+    """Get the ids of the containers with I3DT marks from the tree mirror."""
+    marks = dict()
+    for node in TREE['index'].values():
+        for mark in node.get('marks', []):
+            if mark.startswith('I3DT_'):
+                marks[mark] = node['id']
+    return marks
+
+
+def state_save(ipc):
+    """Write the state snapshot if it changed since the last write.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+
+    """
+    if not DATA['state_file']:
+        return
+    with LOCK:
+        state = json.dumps({
+            'version': STATE['version'],
+            'socket': ipc.socket_path,
+            'layout': I3DT_LAYOUT,
+            'focus': {
+                'previous': FOCUS['previous'],
+                'current': FOCUS['current'],
+                'history': {k: list(v) for k, v in FOCUS['history'].items()}
+                },
+            'marks': state_marks()
+            }, sort_keys=True)
+    if state == STATE['written']:
+        return
+    path = DATA['state_file']
+    try:
+        with open(path + '.tmp', 'w') as stream:
+            stream.write(state)
+        os.replace(path + '.tmp', path)
+    except OSError as error:
+        logging.error('State::Save::%s', error)
+        return
+    STATE['written'] = state
+    logging.debug('State::Save::%s', path)
+
+
+def state_load(ipc):
+    """Restore the state snapshot of a previous instance.
+
+    The saved layouts of a workspace are only restored if its I3DT marks are
+    still on the same containers, and the focus history if the windows still
+    exist. The tree mirror must be synced.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+
+    """
+    if not DATA['state_file'] or not os.path.exists(DATA['state_file']):
+        return
+    try:
+        with open(DATA['state_file']) as stream:
+            state = json.load(stream)
+    except (OSError, ValueError) as error:
+        logging.warning('State::Load::%s', error)
+        return
+    if not isinstance(state, dict) \
+            or state.get('version') != STATE['version'] \
+            or state.get('socket') != ipc.socket_path:
+        logging.info('State::Load::Discarded')
+        return
+    try:
+        state_restore(state)
+    except (AttributeError, TypeError, ValueError) as error:
+        logging.warning('State::Load::Malformed::%s', error)
+        return
+    workspace = tree_workspace(FOCUS['current'])
+    if workspace is not None:
+        focus_record(workspace['name'], FOCUS['current'])
+    logging.info('State::Load::%s', ', '.join(sorted(I3DT_LAYOUT)))
+
+
+def state_restore(state):
+    """Restore the layouts and the focus history of a decoded snapshot.
+
+    Missing entries, as in a truncated or older snapshot, are skipped, and
+    the layouts are only restored when they name both split containers.
+
+    """
+    marks = state_marks()
+    saved = state.get('marks') or dict()
+    for name, layout in (state.get('layout') or dict()).items():
+        if not isinstance(layout, dict) \
+                or not all(k in layout for k in ['main', 'scnd']):
+            continue
+        keys = ['I3DT_{}_{}'.format(k, name) for k in ['GLBL', 'MAIN', 'SCND']]
+        if all(marks.get(k) == saved.get(k) for k in keys):
+            I3DT_LAYOUT[name] = layout
+    focus = state.get('focus') or dict()
+    previous = [focus.get('current'), focus.get('previous')]
+    previous = [w for w in previous
+                if w in TREE['index'] and w != FOCUS['current']]
+    if previous:
+        FOCUS['previous'] = previous[0]
+    for name, history in (focus.get('history') or dict()).items():
+        for cid in history:
+            if cid in TREE['index']:
+                focus_record(name, cid)
+
+
+def state_schedule(ipc):
+    """Write the state snapshot periodically."""
+    state_save(ipc)
+    STATE['timer'] = threading.Timer(DATA['state_interval'], state_schedule,
+                                     (ipc,))
+    STATE['timer'].daemon = True
+    STATE['timer'].start()
+
+
+###############################################################################
+# Control socket                                                              #
+###############################################################################
+
+def control_send(path, command, timeout=5.0):
+    """Send a command to a running instance over the control socket.
+
+    Parameters
+    ----------
+    path : str
+        The path of the control socket
+    command : str
+        The command, for example 'i3ipc_focus next'
+    timeout : float, optional
+        Seconds to wait for the reply (default 5)
+
+    Returns
+    -------
+    dict
+        The reply with 'success' and, on failure, 'error'
+
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(path)
+        client.sendall('{}\n'.format(command).encode())
+        with client.makefile('r') as stream:
+            reply = stream.readline()
+    return json.loads(reply) if reply else {'success': False,
+                                            'error': 'No reply'}
+
+
+def control_listen(path, timeout):
+    """Take over the control socket, which is the single-instance lock.
+
+    A running instance is asked to quit and is given the timeout to clean up
+    before the socket is bound. A socket that nobody listens on is stale and
+    removed, as is the socket of an instance that does not reply or quit
+    within the timeout.
+
+    Parameters
+    ----------
+    path : str
+        The path of the control socket
+    timeout : float
+        Seconds to wait for a running instance to reply, and then to quit
+
+    """
+    try:
+        control_send(path, 'quit', timeout)
+        logging.info('Control::Handover')
+    except (ConnectionRefusedError, FileNotFoundError):
+        pass
+    except (OSError, ValueError) as error:
+        # socket.timeout is an OSError, a hung instance is waited for below.
+        logging.warning('Control::Handover::Error: {}'.format(error))
+    deadline = time.monotonic() + timeout
+    while os.path.exists(path):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.settimeout(max(deadline - time.monotonic(), 0.05))
+                probe.connect(path)
+        except ConnectionRefusedError:
+            os.unlink(path)
+            break
+        except FileNotFoundError:
+            break
+        except OSError:
+            pass
+        if time.monotonic() > deadline:
+            logging.warning('Control::Handover::Timeout')
+            os.unlink(path)
+            break
+        time.sleep(0.05)
+    # Bind with a restrictive umask, the socket is never reachable by other
+    # users, not even between the bind and a chmod.
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(8)
+    CONTROL['server'] = server
+    CONTROL['inode'] = os.stat(path).st_ino
+
+
+def control_command(ipc, command):
+    """Run a command received on the control socket.
+
+    The commands are the ones handled by on_binding(), with or without the
+    'nop' prefix. The plain i3 commands are run by the window manager as when
+    bound to a key.
+
+    Returns
+    -------
+    dict or str
+        The handler metrics for the 'stats' command, the depth of the event
+        queues for the 'queues' command, the counts of the suppressed echo
+        events for the 'echoes' command, the planned commands per workspace
+        for the 'plan' command, the debug records for the 'log' command, the
+        output file for the 'profile' commands and None otherwise.
+
+    """
+    if command.startswith('nop '):
+        command = command[len('nop '):]
+    if command == 'stats':
+        return metrics_summary()
+    if command == 'queues':
+        return dispatch_depth()
+    if command == 'echoes':
+        return dict(ECHO['suppressed'])
+    if command == 'log':
+        return logging_dump()
+    if command.startswith('profile '):
+        args = command.split(' ')[1:]
+        if len(args) != 2:
+            raise ValueError('Usage: profile sample SECONDS | events COUNT')
+        return profile_start(*args)
+    if command == 'plan' or command.startswith('plan '):
+        names = command.split(' ')[1:] or None
+        with LOCK:
+            return {plan['workspace']: layout_commands(plan)
+                    for plan in reconcile_plans(ipc, names)}
+    control_binding(ipc, command)
+    return None
+
+
+@buffered
+def control_binding(ipc, command):
+    """Run a binding received on the control socket."""
+    coalesce_flush_all(ipc)
+    if command.startswith('i3ipc_'):
+        if not run_binding(ipc, 'nop ' + command):
+            raise ValueError('Unknown command: {}'.format(command))
+    elif command == 'kill':
+        i3ipc_kill(ipc)
+        execute_commands(ipc, command)
+    elif command == 'layout toggle tabbed split':
+        execute_commands(ipc, command)
+        i3ipc_layout(ipc)
+    else:
+        raise ValueError('Unknown command: {}'.format(command))
+
+
+def control_serve(ipc):
+    """Answer the clients of the control socket one at a time."""
+    server = CONTROL['server']
+    while True:
+        try:
+            client, _ = server.accept()
+        except OSError:
+            return
+        with client:
+            client.settimeout(1.0)
+            try:
+                with client.makefile('r') as stream:
+                    command = stream.readline().strip()
+                logging.info('Control::%s', command)
+                if command == 'quit':
+                    reply = {'success': True}
+                    client.sendall((json.dumps(reply) + '\n').encode())
+                    shutdown(ipc)
+                    continue
+                try:
+                    result = control_command(ipc, command)
+                    reply = {'success': True}
+                    if result is not None:
+                        reply['result'] = result
+                except Exception as error:  # pylint: disable=broad-except
+                    logging.exception('Control::%s', command)
+                    reply = {'success': False, 'error': str(error)}
+                client.sendall((json.dumps(reply) + '\n').encode())
+            except OSError as error:
+                logging.warning('Control::%s', error)
+
+
+def control_start(ipc):
+    """Serve the control socket from a background thread."""
+    if CONTROL['server'] is None:
+        return
+    CONTROL['thread'] = threading.Thread(target=control_serve, args=(ipc,),
+                                         daemon=True)
+    CONTROL['thread'].start()
+
+
+def control_close():
+    """Close the control socket and remove it unless already taken over."""
+    server = CONTROL['server']
+    if server is None:
+        return
+    CONTROL['server'] = None
+    path = server.getsockname()
+    server.close()
+    try:
+        if os.stat(path).st_ino == CONTROL['inode']:
+            os.unlink(path)
+    except OSError:
+        pass
+
+
+###############################################################################
+# Focus history                                                               #
+###############################################################################
+
+def focus_record(name, con_id):
+    """Record a window as the most recently focused one of a workspace.
+
+    The history of every workspace is an ordered dictionary with the most
+    recently focused window last, bounded to the focus history size.
+
+    Parameters
+    ----------
+    name : str
+        The name of the workspace of the window
+    con_id : int
+        The container id of the focused window
+
+    """
+    focus_forget(con_id)
+    history = FOCUS['history'].setdefault(name, collections.OrderedDict())
+    history[con_id] = None
+    if len(history) > DATA['focus_history']:
+        history.popitem(last=False)
+
+
+def focus_forget(con_id):
+    """Remove a window from the focus history of all workspaces."""
+    for history in FOCUS['history'].values():
+        history.pop(con_id, None)
+
+
+def focus_recent(index=1):
+    """Get a recently focused window of the focused workspace.
+
+    Parameters
+    ----------
+    index : int, optional
+        The position in the history, where 1 is the previously focused
+        window (default 1)
+
+    Returns
+    -------
+    int
+        The container id, or None if the history is not long enough
+
+    """
+    history = FOCUS['history'].get(TREE['workspace'], ())
+    for cid in reversed(history):
+        if cid == FOCUS['current']:
+            continue
+        index -= 1
+        if index <= 0:
+            return cid
+    return None
+
+
+def focus_fullscreen():
+    """Check if the focused window or one of its parents is in fullscreen.
+
+    The check is done on the tree mirror, and a stale mirror is assumed to be
+    in fullscreen since it cannot be decided without the tree.
+
+    """
+    if TREE['dirty']:
+        return True
+    node = TREE['index'].get(TREE['focused'])
+    while node is not None and node.get('type') != 'workspace':
+        if node.get('fullscreen_mode'):
+            return True
+        node = TREE['parents'].get(node['id'])
+    return False
+
+
+###############################################################################
+# Workspace information                                                       #
+###############################################################################
+
+class ContainerInfo:
+    """The state of a marked split container.
+
+    Parameters
+    ----------
+    mark : str
+        The mark of the container
+    layout : str
+        The layout of the container when it does not exist
+
+    """
+
+    __slots__ = ('mark', 'id', 'focus', 'fullscreen', 'layout', 'orientation',
+                 'children', 'members')
+
+    def __init__(self, mark, layout):
+        self.mark = mark
+        self.id = None
+        self.focus = None
+        self.fullscreen = 0
+        self.layout = layout
+        self.orientation = 'horizontal'
+        self.children = ()
+        self.members = frozenset()
+
+
+class WorkspaceInfo:
+    """The state of a workspace.
+
+    The windows of the workspace are kept in tree order in `children`, `tiled`
+    and `unmanaged`, and `roles` maps every window id to one of 'main',
+    'scnd', 'unmanaged' or 'floating'.
+
+    Parameters
+    ----------
+    workspace : i3ipc.Con
+        The workspace container
+
+    """
+
+    __slots__ = ('mode', 'name', 'layout', 'id', 'focused', 'fullscreen',
+                 'children', 'tiled', 'unmanaged', 'descendants', 'parents',
+                 'cons', 'roles', 'glbl', 'main', 'scnd', 'workspace')
+
+    def __init__(self, workspace):
+        self.mode = 'manual'
+        self.name = workspace.name
+        self.layout = workspace.layout
+        self.id = workspace.id
+        self.workspace = workspace
+        self.focused = None
+        self.fullscreen = False
+        self.children = ()
+        self.tiled = ()
+        self.unmanaged = ()
+        self.descendants = ()
+        self.parents = dict()
+        self.cons = dict()
+        self.roles = dict()
+        self.glbl = ContainerInfo('I3DT_GLBL_{}'.format(workspace.name),
+                                  'splith')
+        self.main = ContainerInfo('I3DT_MAIN_{}'.format(workspace.name),
+                                  'splitv')
+        self.scnd = ContainerInfo('I3DT_SCND_{}'.format(workspace.name),
+                                  'splitv')
+
+    def __getitem__(self, key):
+        """Get a split container by key: 'glbl', 'main' or 'scnd'."""
+        return getattr(self, key)
+
+
+###############################################################################
+# Opacity                                                                     #
+###############################################################################
+
+def opacity_target(info, cid, focused):
+    """Get the opacity a window should have.
+
+    The windows of tabbed and stacked containers all get the focused opacity,
+    and the hidden ones are skipped until they become visible.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The workspace information
+    cid : int
+        A window id
+    focused : int
+        The focused window id
+
+    Returns
+    -------
+    float
+        The opacity, or None if the window is hidden
+
+    """
+    role = info.roles[cid]
+    layout = OPACITY['layouts'].get(role, 'splith')
+    if layout in ['splith', 'splitv']:
+        if cid == focused:
+            return DATA['opacity']['focused']
+        return DATA['opacity']['inactive']
+    visible = focused if info.roles.get(focused) == role else info[role].focus
+    if info.parents.get(cid) == info[role].id and cid != visible:
+        return None
+    return DATA['opacity']['focused']
+
+
+def opacity_commands(info, focused=None, layouts=None, keys=None):
+    """Generate the opacity commands for the windows that need a change.
+
+    The last opacity applied to every window is recorded, so only the
+    differences are emitted. The workspace information and the layouts are
+    cached to resolve later focus changes without reading the tree.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The workspace information
+    focused : int, optional
+        The focused window id (default info.focused)
+    layouts : dict, optional
+        The layouts the split containers are about to get
+    keys : list, optional
+        Only update the windows with these roles (default all)
+
+    Returns
+    -------
+    list
+        List of commands to run
+
+    """
+    if DATA['variant'] != 'sway':
+        return []
+    if OPACITY['info'] is not info:
+        OPACITY['info'] = info
+        OPACITY['layouts'] = {k: info[k].layout for k in ['main', 'scnd']}
+    OPACITY['layouts'].update(layouts or {})
+    focused = focused or info.focused
+    commands = []
+    for cid, role in info.roles.items():
+        if keys and role not in keys:
+            continue
+        opacity = opacity_target(info, cid, focused)
+        if opacity is None or OPACITY['applied'].get(cid) == opacity:
+            continue
+        OPACITY['applied'][cid] = opacity
+        commands.append('[con_id={}] opacity {}'.format(cid, opacity))
+    return commands
+
+
+###############################################################################
+# Layout model                                                                #
+###############################################################################
+
+def layout_model(info, adopt=()):
+    """Compute the desired split containers of a workspace.
+
+    The main container keeps its windows, but never becomes empty, and the
+    secondary container gets its own windows and the adopted ones. Without
+    a main container, the only window of the secondary container becomes
+    the main container, or the first two unmanaged windows are split when
+    windows are adopted.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The state of the workspace
+    adopt : iterable, optional
+        The ids of the windows that should be in the split containers, the
+        unmanaged ones and the ones of the main container (default none)
+
+    Returns
+    -------
+    dict or None
+        The window ids of the 'main' and 'scnd' containers, in order, and the
+        'layouts' of new containers, or None if the workspace is left alone.
+
+    """
+    if info.mode == 'manual':
+        return None
+    adopt = set(adopt)
+    if info.main.id:
+        main = [cid for cid in info.main.children if cid not in adopt]
+        main = main or list(info.main.children[:1])
+        scnd = list(info.scnd.children)
+    elif info.scnd.id:
+        main = list(info.scnd.children[:1])
+        scnd = list(info.scnd.children[1:])
+    elif len(info.unmanaged) > 1 and adopt.intersection(info.unmanaged):
+        main = list(info.unmanaged[:1])
+        scnd = list(info.unmanaged[1:])
+    else:
+        return None
+    scnd.extend(cid for cid in info.tiled if cid in adopt
+                and cid not in main and cid not in scnd)
+    layouts = dict(I3DT_LAYOUT.get(info.name, {}))
+    if info.layout == 'tabbed' or info.glbl.layout == 'tabbed':
+        layouts = {'main': 'tabbed', 'scnd': 'tabbed'}
+    return {'main': main, 'scnd': scnd, 'layouts': layouts}
+
+
+def layout_split(info, plan, key, con_id, layout):
+    """Plan the creation of a split container around a window.
+
+    The window is split, and the new container is marked once its id is
+    known, or the parent is marked right away when it is reused.
+
+    Returns
+    -------
+    bool
+        False if no split container can be created, True otherwise.
+
+    """
+    mark = info[key].mark
+    parent = find_split_parent(info, con_id)
+    if parent == info.id:
+        logging.warning('Workspace::Reconcile::No split container')
+        return False
+    plan['split'].append('[con_id={}] unmark'.format(con_id))
+    if parent is None:
+        plan['split'].append('[con_id={}] splitv'.format(con_id))
+        plan['mark'].append((con_id, mark))
+        current = 'splitv'
+    else:
+        plan['split'].append('[con_id={}] mark {}'.format(parent, mark))
+        current = info.cons[parent].layout
+    if layout and layout != current:
+        plan['layout'].append('[con_id={}] layout {}'.format(
+            con_id, 'stacking' if layout == 'stacked' else layout))
+    return True
+
+
+def layout_plan(info, model):
+    """Diff the desired split containers against the workspace.
+
+    Only the missing containers are created and only the windows that are
+    not in their container are moved.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The state of the workspace
+    model : dict
+        The desired split containers from layout_model()
+
+    Returns
+    -------
+    dict
+        The commands that 'split' windows and mark reused containers, the
+        windows whose new parent gets a 'mark', the windows to 'move' to a
+        mark, the 'layout' commands of the new containers, and the container
+        key and window of a 'deferred' repair that needs the focus.
+
+    """
+    plan = {'workspace': info.name, 'split': [], 'mark': [], 'move': [],
+            'layout': [], 'deferred': None}
+    layouts = model['layouts']
+    scnd = bool(info.scnd.id)
+    if not info.main.id:
+        cid = model['main'][0]
+        if info.scnd.id and len(info.scnd.children) > 1:
+            plan['deferred'] = ('main', cid)
+            return plan
+        if info.scnd.id:
+            plan['split'].extend(rename_secondary_container(info))
+            scnd = False
+        elif not layout_split(info, plan, 'main', cid, layouts.get('main')):
+            return plan
+    movers = [cid for cid in model['scnd']
+              if not scnd or info.roles.get(cid) != 'scnd']
+    if movers and not scnd:
+        seed = next((cid for cid in movers
+                     if info.roles.get(cid) == 'unmanaged'), None)
+        if seed is None:
+            plan['deferred'] = ('scnd', movers[0])
+            return plan
+        if not layout_split(info, plan, 'scnd', seed, layouts.get('scnd')):
+            return plan
+        movers.remove(seed)
+    plan['move'] = [(cid, info.scnd.mark) for cid in movers]
+    return plan
+
+
+def layout_commands(plan):
+    """Get the commands of a plan as they would be sent.
+
+    The ids of the new containers are only known after the split, the mark
+    commands refer to the parent of the split window instead. A deferred
+    repair is listed first, as the rest of the plan is computed again once it
+    is done.
+
+    """
+    deferred = []
+    if plan['deferred']:
+        deferred.append('<deferred: create the {} container from [con_id={}]'
+                        ' with the focus>'.format(*plan['deferred']))
+    return (deferred + plan['split']
+            + ['[con_id=<parent of {}>] mark {}'.format(cid, mark)
+               for cid, mark in plan['mark']]
+            + ['[con_id={}] move to mark {}'.format(cid, mark)
+               for cid, mark in plan['move']]
+            + plan['layout'])
+
+
+def layout_execute(ipc, plans, focused=None, changed=False):
+    """Send the commands of the plans of one or more workspaces.
+
+    All splits are sent in one command, and once the new containers are known
+    from a single tree request, one command marks them, moves the windows and
+    restores the layouts. In the dry run mode the commands are only logged.
+    The plans with a deferred repair are not sent, the repair is logged.
 
-###############################################################################
-# Global variables                                                            #
-###############################################################################
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    plans : list
+        The plans from layout_plan()
+    focused : int, optional
+        The id of the window to focus after the changes (default none)
+    changed : bool, optional
+        Focus the window even if the plans are empty, as the focus was moved
+        by a repair (default False)
 
-DATA = {
-    'initialized': False,
-    'opacity': {
-        'focused': 1.0,
-        'inactive': 1.0
-        },
-    'variant': None,
-    'hide_bar': False,
-    'workspace_ignore': []
-    }
-I3DT_LAYOUT = dict()
-FOCUS = {'previous': None, 'current': None}
+    """
+    if DATA['dry_run']:
+        for plan in plans:
+            for command in layout_commands(plan):
+                logging.info('Workspace::Plan::%s: %s', plan['workspace'],
+                             command)
+        return
+    for plan in plans:
+        if plan['deferred']:
+            logging.info('Workspace::Plan::%s::Deferred: %s',
+                         plan['workspace'], layout_commands(plan)[0])
+    plans = [plan for plan in plans if not plan['deferred']]
+    command = [cmd for plan in plans for cmd in plan['split']]
+    marks = [mark for plan in plans for mark in plan['mark']]
+    failed = set()
+    if marks:
+        execute_commands(ipc, command)
+        command = []
+        tree_sync(ipc)
+        for cid, mark in marks:
+            parent = TREE['parents'].get(cid)
+            if parent is not None and parent['type'] == 'con':
+                command.append('[con_id={}] mark {}'
+                               .format(parent['id'], mark))
+            else:
+                logging.warning('Workspace::Reconcile::No split container')
+                failed.add(mark)
+    for plan in plans:
+        command.extend('[con_id={}] move to mark {}'.format(cid, mark)
+                       for cid, mark in plan['move'] if mark not in failed)
+        command.extend(plan['layout'])
+    if (command or changed) and focused:
+        command.append('[con_id={}] focus'.format(focused))
+    execute_commands(ipc, command)
 
 
 ###############################################################################
 # Helper functions                                                            #
 ###############################################################################
 
+def round_trips():
+    """Get the number of IPC round trips made so far."""
+    return ROUND_TRIPS['command'] + ROUND_TRIPS['tree']
+
+
 def execute_commands(ipc, commands, preamble='Executing:'):
-    """Execute a chain of commands."""
+    """Execute a chain of commands.
+
+    While an event is handled the chain is appended to the command buffer
+    and sent by command_flush() when the handler returns, or earlier when the
+    tree is read. Otherwise it is sent right away. The tree mirror is
+    invalidated and the echoes are expected as soon as the chain is issued,
+    so that the mirror is not read as current while the chain is buffered.
+
+    """
     if commands:
         if preamble:
             logging.debug(preamble)
-        if isinstance(commands, list):
-            parsed_commands = [x for x in commands if x]
-            commands = parsed_commands
-            reply = ipc.command('; '.join(commands))
-            for ind, cmd in enumerate(commands):
-                logging.debug('+ %s => %s', cmd, reply[ind].ipc_data)
-                if not reply[ind].success:
-                    logging.error(reply[ind].error)
+        chain = commands if isinstance(commands, list) else [commands]
+        chain = [x for x in ';'.join(x for x in chain if x).split(';') if x]
+        if not tree_patchable(chain):
+            tree_invalidate()
+        if BUFFER['depth']:
+            pending = [cmd for cmds in BUFFER['chains'] for cmd in cmds]
+            echo_expect(pending + chain, len(pending))
+            BUFFER['chains'].append(chain)
+            BUFFER['frames'].extend(meter_buffered())
         else:
-            reply = ipc.command(commands)
-            logging.debug('+ %s => %s', commands, reply[0].ipc_data)
-            if not reply[0].success:
-                logging.error(reply[0].error)
+            echo_expect(chain)
+            command_send(ipc, chain)
     return []
 
 
+@metered
 def get_workspace_info(ipc, workspace=None):
     """Collect the state of the window manager."""
     if not workspace:
-        tree = ipc.get_tree()
-        focused = tree.find_focused()
-        workspace = focused.workspace()
-
-    # Initialize the dictionary.
-    info = {
-        'mode': 'manual',
-        'name': workspace.name,
-        'layout': workspace.layout,
-        'children': [],
-        'tiled': [],
-        'descendants': [],
-        'id': workspace.id,
-        'focused': None,
-        'fullscreen': False,
-        'unmanaged': [],
-        'glbl': {
-            'mark': 'I3DT_GLBL_{}'.format(workspace.name),
-            'id': None,
-            'orientation': 'horizontal',
-            'layout': 'splith'
-            },
-        'main': {
-            'mark': 'I3DT_MAIN_{}'.format(workspace.name),
-            'fullscreen': 0,
-            'id': None,
-            'focus': None,
-            'layout': 'splitv',
-            'children': []
-            },
-        'scnd': {
-            'mark': 'I3DT_SCND_{}'.format(workspace.name),
-            'fullscreen': 0,
-            'id': None,
-            'focus': None,
-            'layout': 'splitv',
-            'children': [],
-            },
-        }
+        workspace = tree_focused_workspace(ipc)
+    info = WorkspaceInfo(workspace)
 
     # Collect workspace information.
     if workspace.name not in DATA['workspace_ignore']:
-        info['mode'] = 'tiled'
-
-    info['descendants'] = workspace.descendants()
-    for con in workspace.leaves():
-        info['children'].append(con.id)
-        if not con.floating or not con.floating.endswith('on'):
-            info['tiled'].append(con.id)
-
-    for con in info['descendants']:
-        marks = con.marks
-        if con.focused:
-            info['focused'] = con.id
-            info['fullscreen'] = con.fullscreen_mode
-        if info['glbl']['mark'] in marks:
-            info['glbl']['id'] = con.id
-            info['glbl']['orientation'] = con.orientation
-            info['glbl']['layout'] = con.layout
-        for name in ['main', 'scnd']:
-            if info[name]['mark'] in marks:
-                info[name]['id'] = con.id
-                if con.focus:
-                    info[name]['focus'] = con.focus[0]
-                info[name]['fullscreen'] = con.fullscreen_mode
-                info[name]['layout'] = con.layout
-                info[name]['children'] = list(d.id for d in con.leaves())
-
-    # Find unmanaged windows.
-    info['unmanaged'] = copy.deepcopy(info['tiled'])
-    for cid in info['main']['children']:
-        info['unmanaged'].remove(cid)
-    for cid in info['scnd']['children']:
-        info['unmanaged'].remove(cid)
+        info.mode = 'tiled'
+
+    # Traverse the containers in breadth-first order, the list is extended
+    # while it is traversed. Every container inherits the split container key
+    # of its parent unless it is marked itself.
+    marks = {c.mark: k for k, c in [('main', info.main), ('scnd', info.scnd)]}
+    keys = {workspace.id: None}
+    descendants = [workspace]
+    for con in descendants:
+        if con is not workspace:
+            workspace_info_visit(info, con, marks, keys)
+        for child in con.nodes + con.floating_nodes:
+            info.parents[child.id] = con.id
+            info.cons[child.id] = child
+            keys[child.id] = keys[con.id]
+            descendants.append(child)
+    info.descendants = tuple(descendants[1:])
+
+    # Collect the windows per role.
+    info.children = tuple(info.roles)
+    info.tiled = tuple(k for k, v in info.roles.items() if v != 'floating')
+    info.unmanaged = tuple(k for k, v in info.roles.items()
+                           if v == 'unmanaged')
+    for key in ['main', 'scnd']:
+        info[key].children = tuple(k for k, v in info.roles.items()
+                                   if v == key)
+        info[key].members = frozenset(info[key].children)
 
     return info
 
 
+def workspace_info_visit(info, con, marks, keys):
+    """Collect the state of a single container of a workspace."""
+    if con.focused:
+        info.focused = con.id
+        info.fullscreen = con.fullscreen_mode
+    for mark in con.marks:
+        if mark == info.glbl.mark:
+            info.glbl.id = con.id
+            info.glbl.orientation = con.orientation
+            info.glbl.layout = con.layout
+        elif mark in marks:
+            cont = info[marks[mark]]
+            cont.id = con.id
+            if con.focus:
+                cont.focus = con.focus[0]
+            cont.fullscreen = con.fullscreen_mode
+            cont.layout = con.layout
+            keys[con.id] = marks[mark]
+    if not con.nodes and con.type == 'con':
+        if con.floating and con.floating.endswith('on'):
+            info.roles[con.id] = 'floating'
+        else:
+            info.roles[con.id] = keys[con.id] or 'unmanaged'
+
+
 def rename_secondary_container(info):
     """Rename the secondary container to the main container."""
     command = []
     command.append('[con_id={}] unmark {}'
-                   .format(info['scnd']['id'], info['scnd']['mark']))
+                   .format(info.scnd.id, info.scnd.mark))
     command.append('[con_id={}] mark {}'
-                   .format(info['scnd']['id'], info['main']['mark']))
+                   .format(info.scnd.id, info.main.mark))
     return command
 
 
 def restore_container_layout(key, info):
     """Restore the saved container layout."""
-    if not info[key]['id']:
+    if not info[key].id:
         return []
 
-    if info['name'] not in I3DT_LAYOUT:
-        I3DT_LAYOUT[info['name']] = {'main': 'splitv', 'scnd': 'splitv'}
+    if info.name not in I3DT_LAYOUT:
+        I3DT_LAYOUT[info.name] = {'main': 'splitv', 'scnd': 'splitv'}
 
     commands = []
-    if info[key]['layout'] != I3DT_LAYOUT[info['name']][key]:
-        if I3DT_LAYOUT[info['name']][key] == 'stacked':
+    if info[key].layout != I3DT_LAYOUT[info.name][key]:
+        if I3DT_LAYOUT[info.name][key] == 'stacked':
             commands.append('[con_id={}] layout {}'
-                            .format(info[key]['children'][0], 'stacking'))
+                            .format(info[key].children[0], 'stacking'))
         else:
             commands.append('[con_id={}] layout {}'
-                            .format(info[key]['children'][0],
-                                    I3DT_LAYOUT[info['name']][key]))
-        if DATA['variant'] == 'sway':
-            if I3DT_LAYOUT[info['name']][key] in ['splith', 'splitv']:
-                for cid in info[key]['children']:
-                    if cid == info['focused']:
-                        commands.append('[con_id={}] opacity {}'
-                                        .format(cid,
-                                                DATA['opacity']['focused']))
-                    else:
-                        commands.append('[con_id={}] opacity {}'
-                                        .format(cid,
-                                                DATA['opacity']['inactive']))
-            else:
-                for cid in info[key]['children']:
-                    commands.append('[con_id={}] opacity {}'
-                                    .format(cid, DATA['opacity']['focused']))
+                            .format(info[key].children[0],
+                                    I3DT_LAYOUT[info.name][key]))
+        commands.extend(opacity_commands(
+            info, layouts={key: I3DT_LAYOUT[info.name][key]}, keys=[key]))
     return commands
 
 
 def save_container_layout(key, info):
     """Save the container layout."""
-    if info['name'] not in I3DT_LAYOUT:
-        I3DT_LAYOUT[info['name']] = {'main': 'splitv', 'scnd': 'splitv'}
-    if info[key]['id']:
-        I3DT_LAYOUT[info['name']][key] = info[key]['layout']
+    if info.name not in I3DT_LAYOUT:
+        I3DT_LAYOUT[info.name] = {'main': 'splitv', 'scnd': 'splitv'}
+    if info[key].id:
+        I3DT_LAYOUT[info.name][key] = info[key].layout
+
 
+def find_split_parent(info, con_id):
+    """Find the parent that is reused when a window is split.
 
-def find_parent_id(con_id, info):
-    """Find the parent container id."""
-    parent = None
-    containers = (con for con in info['descendants'] if not con.name)
-    for con in containers:
-        for dsc in con.descendants():
-            if dsc.id == con_id:
-                parent = con.id
-                break
-    return parent
+    Splitting the only child of a split container changes the orientation of
+    the parent instead of creating a new container. The parent id, which is
+    the workspace id when the window is alone on the workspace, is returned
+    in that case and None otherwise.
+
+    """
+    parent = info.parents.get(con_id)
+    if parent is None:
+        return None
+    con = info.cons.get(parent, info.workspace)
+    if len(con.nodes) == 1 and con.layout in ['splith', 'splitv']:
+        return parent
+    return None
 
 
+@metered
 def create_container(ipc, name, con_id=None):
     """Create a split container for the specified container id.
 
@@ -238,13 +2594,14 @@ def create_container(ipc, name, con_id=None):
     info = get_workspace_info(ipc)
 
     # Exit if container already exists.
-    if info[name]['id']:
+    if info[name].id:
         raise ValueError('Container already exist!')
 
     # Get the window that should be contained and make sure it is
     # focused.
     command = []
-    focused = info['focused']
+    target = None
+    focused = info.focused
     if not con_id:
         con_id = focused
     else:
@@ -255,46 +2612,31 @@ def create_container(ipc, name, con_id=None):
 
     # Move the window outside any other container.
     other = 'main' if name == 'scnd' else 'scnd'
-    if con_id in info[other]['children']:
-        if info['glbl']['id']:
+    if con_id in info[other].members:
+        if info.glbl.id:
             command.append('move to mark {}; splitv'
-                           .format(info['glbl']['mark']))
+                           .format(info.glbl.mark))
         else:
+            vertical = info.layout in ['splitv', 'stacked']
+            children = list(info[other].children)
             if other == 'main':
-                move = 'right'
-                if info['layout'] in ['splitv', 'stacked']:
-                    move = 'down'
-
-                # Move the to the edge of the container.
-                index = 0
-                for cid in info['main']['children']:
-                    if info['focused'] == cid:
-                        break
-                    index += 1
-                layout = info['main']['layout']
-                if (layout in ['splith', 'tabbed'] and move == 'right') or \
-                        (layout in ['splitv', 'stacked'] and move == 'down'):
-                    command.extend(['move {}'.format(move)]
-                                   * (len(info['main']['children']) - index))
+                move = 'down' if vertical else 'right'
+                edge = len(children) - 1
             else:
-                move = 'left'
-                if info['layout'] in ['splitv', 'stacked']:
-                    move = 'up'
-
-                # Move the to the edge of the container.
-                index = 0
-                for cid in info['scnd']['children']:
-                    if info['focused'] == cid:
-                        break
-                    index += 1
-                layout = info['main']['layout']
-                if (layout in ['splith', 'tabbed'] and move == 'left') \
-                        or (layout in ['splitv', 'stacked'] and move == 'up'):
-                    command.extend(['move {}'.format(move)] * (index + 1))
+                move = 'up' if vertical else 'left'
+                edge = 0
+
+            # Move the window to the edge of the container, in a fixed number
+            # of commands, and one step further when the container has the
+            # orientation of the movement.
+            if (info[other].layout in ['splitv', 'stacked']) == vertical:
+                command.extend(
+                    reposition_commands(info, con_id, children, edge))
+                command.append('move {}'.format(move))
 
             # Move outside the split container.
             command.append('move {}'.format(move))
-            if info['layout'] in ['splitv', 'stacked']:
+            if info.layout in ['splitv', 'stacked']:
                 command.append('splith')
                 command.append('resize set height 50 ppt')
             else:
@@ -302,24 +2644,32 @@ def create_container(ipc, name, con_id=None):
                 command.append('resize set width 50 ppt')
     else:
         command.append('[con_id={}] splitv'.format(con_id))
-    command = execute_commands(ipc, command, '')
-
-    # Find and mark the newly created split container.
-    info = get_workspace_info(ipc)
-    parent = find_parent_id(con_id, info)
-    command.append('[con_id={}] mark {}'
-                   .format(parent, info[name]['mark']))
+        target = find_split_parent(info, con_id)
+        if target == info.id:
+            logging.warning('Container::Create::No split container')
+            execute_commands(ipc, command, '')
+            return
+
+    # Mark the split container in the same chain of commands, the newly
+    # created container is the parent of the focused window.
+    if target:
+        criteria = '[con_id={}] '.format(target)
+    else:
+        criteria = ''
+        command.append('focus parent')
+    command.append('{}mark {}'.format(criteria, info[name].mark))
 
     # Make sure that the newly created container is in the global split
     # container.
-    if info['glbl']['id']:
-        command.append('[con_id={}] move to mark {}'
-                       .format(parent, info['glbl']['mark']))
-        if name == 'main' and info['scnd']['id']:
-            command.append('[con_id={}] swap container with con_id {}'
-                           .format(parent, info['scnd']['id']))
+    if info.glbl.id:
+        command.append('{}move to mark {}'.format(criteria, info.glbl.mark))
+        if name == 'main' and info.scnd.id:
+            command.append('{}swap container with con_id {}'
+                           .format(criteria, info.scnd.id))
+    if not target:
+        command.append('[con_id={}] focus'.format(con_id))
 
-    command = execute_commands(ipc, command, '')
+    execute_commands(ipc, command, '')
 
 
 def find_parent_container_key(info, con_id=None):
@@ -327,20 +2677,16 @@ def find_parent_container_key(info, con_id=None):
 
     Parameters
     ----------
-    info : dict
+    info : WorkspaceInfo
         The state of the window manager
     con_id : int, optional
         A container id (default focused)
 
     """
-    key = None
     if not con_id:
-        con_id = info['focused']
-    if info['main']['id'] and con_id in info['main']['children']:
-        key = 'main'
-    elif info['scnd']['id'] and con_id in info['scnd']['children']:
-        key = 'scnd'
-    return key
+        con_id = info.focused
+    role = info.roles.get(con_id)
+    return role if role in ['main', 'scnd'] else None
 
 
 def find_parent_container(info):
@@ -348,24 +2694,19 @@ def find_parent_container(info):
 
     Parameters
     ----------
-    info : dict
+    info : WorkspaceInfo
         The state of the window manager
 
     """
-    parent = None
-    children = []
-    if info['focused'] in info['main']['children']:
-        parent = info['main']['id']
-        layout = info['main']['layout']
-        children = info['main']['children']
-    elif info['focused'] in info['scnd']['children']:
-        parent = info['scnd']['id']
-        layout = info['scnd']['layout']
-        children = info['scnd']['children']
+    key = find_parent_container_key(info)
+    if key:
+        parent = info[key].id
+        layout = info[key].layout
+        children = info[key].children
     else:
-        parent = info['id']
-        layout = info['layout']
-        children = info['tiled']
+        parent = info.id
+        layout = info.layout
+        children = info.tiled
     return parent, layout, children
 
 
@@ -374,22 +2715,74 @@ def find_container_index(info, con_ids=None):
 
     Parameters
     ----------
-    info : dict
+    info : WorkspaceInfo
         The state of the window manager
     con_ids : list, optional
         A list of container id's
 
     """
     if not con_ids:
-        con_ids = info['tiled']
+        con_ids = info.tiled
     ind = 0
     for cid in con_ids:
-        if cid == info['focused']:
+        if cid == info.focused:
             break
         ind += 1
     return ind
 
 
+def reposition_commands(info, con_id, children, index):
+    """Get the commands placing a window at an index among sibling windows.
+
+    The window is moved next to a temporarily marked sibling, and swapped
+    with it to end up in front of it, so the number of commands does not
+    depend on the index, the number of siblings or the nesting. The window
+    does not need to be a sibling already. A split container next to the
+    index is anchored by its last or first window, as a window moved to a
+    marked split container would end up inside it; the window then joins the
+    nested split container, at the index in the order of the windows.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The state of the window manager
+    con_id : int
+        The id of the window to place
+    children : list
+        The ids of the children of the target container
+    index : int
+        The index of the window among the children, clamped to the valid
+        range
+
+    Returns
+    -------
+    list
+        The commands, empty if the window already is at the index.
+
+    """
+    others = [cid for cid in children if cid != con_id]
+    if not others:
+        return []
+    index = max(0, min(index, len(others)))
+    if index < len(children) and children[index] == con_id:
+        return []
+    if index > 0:
+        anchor, swap = others[index - 1], False
+    else:
+        anchor, swap = others[index], True
+    con = info.cons.get(anchor)
+    while con is not None and con.nodes:
+        con = con.nodes[0] if swap else con.nodes[-1]
+        anchor = con.id
+    command = ['[con_id={}] mark --add {}'.format(anchor, REPOSITION_MARK),
+               '[con_id={}] move to mark {}'.format(con_id, REPOSITION_MARK),
+               'unmark {}'.format(REPOSITION_MARK)]
+    if swap:
+        command.append('[con_id={}] swap container with con_id {}'
+                       .format(con_id, anchor))
+    return command
+
+
 def get_movement(layout, direction):
     """Convert next/prev to an i3/sway movement.
 
@@ -417,9 +2810,9 @@ def get_movement(layout, direction):
 def i3ipc_focus_next_prev(ipc, info, key, is_monocle, direction):
     """Focus the next or previous window with wrapping."""
     command = []
-    children = info['tiled']
+    children = info.tiled
     if key and is_monocle:
-        children = info[key]['children']
+        children = info[key].children
     index = find_container_index(info, children)
     length = len(children)
     if length > 1:
@@ -437,42 +2830,62 @@ def i3ipc_focus_next_prev(ipc, info, key, is_monocle, direction):
 def i3ipc_focus_other(ipc, info, key, is_monocle):
     """Focus the window in the other container."""
     command = []
-    if info['scnd']['id']:
+    if info.scnd.id:
         if is_monocle:
             command.extend(i3ipc_monocle_disable_commands(key, info))
         other = 'main' if key == 'scnd' else 'scnd'
-        command.append('[con_id={}] focus'.format(info[other]['focus']))
+        command.append('[con_id={}] focus'.format(info[other].focus))
     else:
         logging.warning('Window::Focus::Other::No other container')
     execute_commands(ipc, command, '')
 
 
-def i3ipc_focus_toggle(ipc, info, key, is_monocle):
-    """Focus the previously focused window."""
+def i3ipc_focus_recent(ipc, index=1):
+    """Focus a recently focused window of the workspace.
+
+    The window is found in the focus history, the workspace information is
+    only needed when the monocle mode may have to be disabled.
+
+    """
+    target = focus_recent(index)
+    if not target:
+        logging.warning('Window::Focus::Recent::No window')
+        return
     command = []
-    if is_monocle and \
-            (not key or FOCUS['previous'] not in info[key]['children']):
-        command.extend(i3ipc_monocle_disable_commands(key, info))
-    if FOCUS['previous']:
-        command.append('[con_id={}] focus'.format(FOCUS['previous']))
-    else:
-        logging.warning('Window::Focus::Toggle::No previous window')
+    if focus_fullscreen():
+        info = get_workspace_info(ipc)
+        key = find_parent_container_key(info)
+        if i3ipc_monocle_enabled(key, info) and \
+                (not key or target not in info[key].members):
+            command.extend(i3ipc_monocle_disable_commands(key, info))
+    command.append('[con_id={}] focus'.format(target))
     execute_commands(ipc, command, '')
 
 
-def i3ipc_focus(ipc, event):
+@metered
+def i3ipc_focus(ipc, command):
     """Different window focus events.
 
     Parameters
     ----------
     ipc : i3ipc.Connection
         An i3ipc connection
-    event : i3ipc.BindingEvent
-        An i3ipc binding event
+    command : str
+        The binding command, for example 'nop i3ipc_focus next'
 
     """
-    action = event.binding.command.split(" ")[-1]
+    args = command.split(" ")[2:] or ['']
+    action = args[0]
     logging.info('Window::Focus::%s', action.title())
+    if action == 'toggle':
+        i3ipc_focus_recent(ipc)
+        return
+    if action == 'mru':
+        try:
+            i3ipc_focus_recent(ipc, int(args[1]))
+        except (IndexError, ValueError):
+            logging.error('Window::Focus::Mru::Invalid index: %s', args[1:])
+        return
     info = get_workspace_info(ipc)
     key = find_parent_container_key(info)
     is_monocle = i3ipc_monocle_enabled(key, info)
@@ -480,8 +2893,6 @@ def i3ipc_focus(ipc, event):
         i3ipc_focus_next_prev(ipc, info, key, is_monocle, action)
     elif action == 'other':
         i3ipc_focus_other(ipc, info, key, is_monocle)
-    elif action == 'toggle':
-        i3ipc_focus_toggle(ipc, info, key, is_monocle)
 
 
 def i3ipc_move_next_prev(ipc, info, direction):
@@ -494,116 +2905,150 @@ def i3ipc_move_next_prev(ipc, info, direction):
     if children:
         movement = get_movement(layout, direction)
         if direction == 'next':
-            if info['focused'] != children[-1]:
+            if info.focused != children[-1]:
                 command.append('move {}'.format(movement))
         elif direction == 'prev':
-            if info['focused'] != children[0]:
+            if info.focused != children[0]:
                 command.append('move {}'.format(movement))
     execute_commands(ipc, command, '')
 
 
+def i3ipc_move_position(ipc, info, index):
+    """Move the focused window to an index within the parent container."""
+    _, _, children = find_parent_container(info)
+    if info.focused not in children:
+        return
+    index = max(0, min(index, len(children) - 1))
+    execute_commands(ipc, reposition_commands(info, info.focused, children,
+                                              index), '')
+
+
 def i3ipc_move_other(ipc, info):
     """Move the focused window to the other container."""
     # Find the parent container of the window and then move the window to the
     # other container. Make sure that the main container does not become empty.
     command = []
-    if info['focused'] in info['main']['children']:
-        if len(info['main']['children']) == 1:
-            if info['scnd']['id']:
+    if info.focused in info.main.members:
+        if len(info.main.children) == 1:
+            if info.scnd.id:
                 command.append('[con_id={}] focus'
-                               .format(info['scnd']['children'][0]))
+                               .format(info.scnd.children[0]))
                 command.append('swap container with con_id {}'
-                               .format(info['focused']))
-        elif info['scnd']['id']:
+                               .format(info.focused))
+        elif info.scnd.id:
             command.append('[con_id={}] move to mark {}'
-                           .format(info['focused'], info['scnd']['mark']))
+                           .format(info.focused, info.scnd.mark))
             command.append('[con_id={}] focus; focus child'
-                           .format(info['main']['id']))
+                           .format(info.main.id))
         else:
             create_container(ipc, 'scnd')
     else:
         command.append('[con_id={}] move to mark {}'
-                       .format(info['focused'], info['main']['mark']))
+                       .format(info.focused, info.main.mark))
         command.append('[con_id={}] focus; focus child'
-                       .format(info['scnd']['id']))
+                       .format(info.scnd.id))
     execute_commands(ipc, command, '')
 
 
 def i3ipc_move_swap(ipc, info):
     """Swap the focused window with other container."""
     command = []
-    if info['scnd']['id']:
-        if info['focused'] in info['scnd']['children']:
+    if info.scnd.id:
+        if info.focused in info.scnd.members:
             command.append('[con_id={}] focus'
-                           .format(info['main']['focus']))
+                           .format(info.main.focus))
         command.append('swap container with con_id {}'
-                       .format(info['scnd']['focus']))
+                       .format(info.scnd.focus))
         command.append('[con_id={}] focus'
-                       .format(info['scnd']['focus']))
+                       .format(info.scnd.focus))
     execute_commands(ipc, command, '')
 
 
-def i3ipc_move(ipc, event):
+@metered
+def i3ipc_move(ipc, command):
     """Different window movements.
 
     Parameters
     ----------
     ipc : i3ipc.Connection
         An i3ipc connection
-    event : i3ipc.BindingEvent
-        An i3ipc binding event
+    command : str
+        The binding command, for example 'nop i3ipc_move next'
 
     """
-    action = event.binding.command.split(" ")[-1]
+    args = command.split(" ")[2:]
+    action = args[0] if args else ''
     logging.info('Window::Move::%s', action.title())
     info = get_workspace_info(ipc)
     if action in ['next', 'prev']:
         i3ipc_move_next_prev(ipc, info, action)
+    elif action == 'first':
+        i3ipc_move_position(ipc, info, 0)
+    elif action == 'last':
+        i3ipc_move_position(ipc, info, len(info.tiled))
+    elif action == 'index' and len(args) == 2 and args[1].isdigit():
+        i3ipc_move_position(ipc, info, int(args[1]) - 1)
     elif action == 'other':
         i3ipc_move_other(ipc, info)
     elif action == 'swap':
         i3ipc_move_swap(ipc, info)
 
 
+def mark_global_container(info):
+    """Generate the commands that mark a newly created global container.
+
+    The container is the parent of the secondary container and the focus is
+    returned to the focused window.
+
+    Parameters
+    ----------
+    info : WorkspaceInfo
+        The workspace information before the container was created
+
+    """
+    command = []
+    command.append('[con_id={}] focus'.format(info.scnd.id))
+    command.append('focus parent')
+    command.append('mark {}'.format(info.glbl.mark))
+    command.append('[con_id={}] focus'.format(info.focused))
+    return command
+
+
 def i3ipc_tabbed_disable(ipc, info):
     """Disable tabbed mode."""
-    if info['layout'] == 'tabbed' or info['glbl']['layout'] == 'tabbed':
-        if DATA['hide_bar']:
-            os.system("polybar-msg cmd show 1>/dev/null")
+    if info.layout == 'tabbed' or info.glbl.layout == 'tabbed':
+        polybar('show')
         command = []
-        if info['scnd']['id']:
+        if info.scnd.id:
             command.append('[con_id={}] layout toggle split'
-                           .format(info['scnd']['id']))
+                           .format(info.scnd.id))
         for k in ['main', 'scnd']:
             command.extend(restore_container_layout(k, info))
         execute_commands(ipc, command, '')
 
 
+@metered
 def i3ipc_tabbed_enable(ipc, info):
     """Enable tabbed mode."""
-    if info['mode'] == 'tiled':
-        if DATA['hide_bar']:
-            os.system("polybar-msg cmd hide 1>/dev/null")
+    if info.mode == 'tiled':
+        polybar('hide')
         command = []
         for k in ['main', 'scnd']:
-            if info[k]['id']:
+            if info[k].id:
                 save_container_layout(k, info)
                 command.append('[con_id={}] layout tabbed'
-                               .format(info[k]['children'][0]))
-        if info['scnd']['id']:
+                               .format(info[k].children[0]))
+        if info.scnd.id:
             command.append('[con_id={}] layout tabbed'
-                           .format(info['scnd']['id']))
-        execute_commands(ipc, command, '')
+                           .format(info.scnd.id))
 
-        # Find the newly created split container and mark it.
-        if DATA['variant'] != 'sway':
-            info = get_workspace_info(ipc)
-            if not info['glbl']['id']:
-                glbl = info['descendants'][0].id
-                execute_commands(ipc, '[con_id={}] mark {}'
-                                 .format(glbl, info['glbl']['mark']), '')
+            # Mark the newly created split container.
+            if DATA['variant'] != 'sway' and not info.glbl.id:
+                command.extend(mark_global_container(info))
+        execute_commands(ipc, command, '')
 
 
+@metered
 def i3ipc_tabbed_toggle(ipc):
     """Toggle the tabbed mode on or off.
 
@@ -615,14 +3060,14 @@ def i3ipc_tabbed_toggle(ipc):
     """
     logging.info('Workspace::Tabbed')
     info = get_workspace_info(ipc)
-    if info['mode'] == 'manual':
+    if info.mode == 'manual':
         return
-    if info['mode'] == 'monocle':
+    if info.mode == 'monocle':
         i3ipc_monocle_toggle(ipc)
         return
-    if info['layout'] == 'tabbed' or info['glbl']['layout'] == 'tabbed':
+    if info.layout == 'tabbed' or info.glbl.layout == 'tabbed':
         i3ipc_tabbed_disable(ipc, info)
-    elif info['mode'] == 'tiled':
+    elif info.mode == 'tiled':
         i3ipc_tabbed_enable(ipc, info)
 
 
@@ -633,8 +3078,8 @@ def i3ipc_monocle_disable_commands(key, info):
     ----------
     key : str
         The name of the split container of the focused window
-    info : dict
-        The current workspace information dictionary
+    info : WorkspaceInfo
+        The current workspace information
 
     Returns
     -------
@@ -643,12 +3088,12 @@ def i3ipc_monocle_disable_commands(key, info):
 
     """
     commands = []
-    if not key and info['fullscreen']:
+    if not key and info.fullscreen:
         commands.append('fullscreen disable')
-    elif info[key]['id'] and info[key]['fullscreen']:
+    elif info[key].id and info[key].fullscreen:
         commands.extend(restore_container_layout(key, info))
         commands.append('[con_id={}] fullscreen toggle'
-                        .format(info[key]['id']))
+                        .format(info[key].id))
     return commands
 
 
@@ -659,8 +3104,8 @@ def i3ipc_monocle_enable_commands(key, info):
     ----------
     key : str
         The name of the split container of the focused window
-    info : dict
-        The current workspace information dictionary
+    info : WorkspaceInfo
+        The current workspace information
 
     Returns
     -------
@@ -669,19 +3114,17 @@ def i3ipc_monocle_enable_commands(key, info):
 
     """
     commands = []
-    if not key and not info['fullscreen']:
+    if not key and not info.fullscreen:
         commands.append('fullscreen enable')
-    elif key and info[key]['id'] and not info[key]['fullscreen']:
+    elif key and info[key].id and not info[key].fullscreen:
         save_container_layout(key, info)
-        if info[key]['layout'] != 'tabbed' \
-                and (len(info[key]['children']) > 1):
+        if info[key].layout != 'tabbed' \
+                and (len(info[key].children) > 1):
             commands.append('layout tabbed')
-            if DATA['variant'] == 'sway':
-                for cid in info[key]['children']:
-                    commands.append('[con_id={}] opacity {}'
-                                    .format(cid, DATA['opacity']['focused']))
+            commands.extend(opacity_commands(info, layouts={key: 'tabbed'},
+                                             keys=[key]))
         commands.append('[con_id={}] fullscreen toggle'
-                        .format(info[key]['id']))
+                        .format(info[key].id))
         if DATA['variant'] != 'sway':
             commands.append('focus child')
     return commands
@@ -694,8 +3137,8 @@ def i3ipc_monocle_toggle_commands(key, info):
     ----------
     key : str
         The name of the split container of the focused window
-    info : dict
-        The current workspace information dictionary
+    info : WorkspaceInfo
+        The current workspace information
 
     Returns
     -------
@@ -718,8 +3161,8 @@ def i3ipc_monocle_enabled(key, info):
     ----------
     key : str
         The name of the split container of the focused window
-    info : dict
-        The current workspace information dictionary
+    info : WorkspaceInfo
+        The current workspace information
 
     Returns
     -------
@@ -728,13 +3171,14 @@ def i3ipc_monocle_enabled(key, info):
 
     """
     enabled = False
-    if not key and info['fullscreen']:
+    if not key and info.fullscreen:
         enabled = True
-    elif key and info[key]['id'] and info[key]['fullscreen']:
+    elif key and info[key].id and info[key].fullscreen:
         enabled = True
     return enabled
 
 
+@metered
 def i3ipc_monocle_toggle(ipc):
     """Toggle the monocle mode on or off.
 
@@ -751,6 +3195,7 @@ def i3ipc_monocle_toggle(ipc):
     execute_commands(ipc, commands, '')
 
 
+@metered
 def i3ipc_mirror(ipc):
     """Mirror the secondary container.
 
@@ -765,11 +3210,12 @@ def i3ipc_mirror(ipc):
     """
     logging.info('Workspace::Mirror')
     info = get_workspace_info(ipc)
-    if info['scnd']['id'] and info['mode'] == 'tiled':
+    if info.scnd.id and info.mode == 'tiled':
         execute_commands(ipc, '[con_id={}] swap container with con_id {}'
-                         .format(info['main']['id'], info['scnd']['id']))
+                         .format(info.main.id, info.scnd.id))
 
 
+@metered
 def i3ipc_reflect(ipc):
     """Reflect the secondary container.
 
@@ -785,35 +3231,38 @@ def i3ipc_reflect(ipc):
     logging.info('Workspace::Reflect')
     info = get_workspace_info(ipc)
     command = []
-    if info['scnd']['id'] and info['mode'] == 'tiled':
+    if info.scnd.id and info.mode == 'tiled':
         # Toggle split on the second container to create a workspace global
         # split container.
         command.append('[con_id={}] layout toggle split'
-                       .format(info['scnd']['id']))
+                       .format(info.scnd.id))
         # Sway does not create a global split container as i3 does.
-        if DATA['variant'] != 'sway' and not info['glbl']['id']:
+        if DATA['variant'] != 'sway' and not info.glbl.id:
+            command.extend(mark_global_container(info))
+        # Update the layout of the containers, the split orientation of the
+        # global container or the workspace is toggled.
+        layout = info.glbl.layout if info.glbl.id else info.layout
+        if layout in ['splith', 'splitv']:
+            orientation = 'vertical' if layout == 'splith' else 'horizontal'
+            if DATA['variant'] == 'sway' and info.glbl.id \
+                    and info.layout == 'splitv':
+                orientation = 'vertical'
+        else:
             command = execute_commands(ipc, command)
             info = get_workspace_info(ipc)
-            command.append('[con_id={}] mark {}'
-                           .format(info['descendants'][0].id,
-                                   info['glbl']['mark']))
-        # Update the layout of the containers.
-        command = execute_commands(ipc, command)
-        info = get_workspace_info(ipc)
-        orientation = 'horizontal'
-        if DATA['variant'] == 'sway' and info['layout'] == 'splitv':
-            orientation = 'vertical'
-        else:
-            orientation = info['glbl']['orientation']
+            orientation = info.glbl.orientation
+            if DATA['variant'] == 'sway' and info.layout == 'splitv':
+                orientation = 'vertical'
         for k in ['main', 'scnd']:
-            layout = info[k]['layout']
+            layout = info[k].layout
             if (layout == 'splitv' and orientation == 'vertical') \
                     or (layout == 'splith' and orientation == 'horizontal'):
                 command.append('[con_id={}] layout toggle split'
-                               .format(info[k]['children'][0]))
+                               .format(info[k].children[0]))
         execute_commands(ipc, command, '')
 
 
+@metered
 def i3ipc_kill(ipc):
     """Close the focused window.
 
@@ -830,17 +3279,122 @@ def i3ipc_kill(ipc):
     # pylint: disable=unused-argument
     logging.info('Window::Close')
     info = get_workspace_info(ipc)
-    if info['mode'] == 'manual':
+    if info.mode == 'manual':
         return
     command = []
-    if info['focused'] in info['main']['children'] \
-            and (len(info['main']['children']) == 1) \
-            and info['scnd']['id']:
+    if info.focused in info.main.members \
+            and (len(info.main.children) == 1) \
+            and info.scnd.id:
         command.append('[con_id={}] swap container with con_id {}'
-                       .format(info['focused'], info['scnd']['children'][0]))
+                       .format(info.focused, info.scnd.children[0]))
     execute_commands(ipc, command)
 
 
+@metered
+def reconcile(ipc, adopt=None):
+    """Repair the split containers and adopt windows on the workspace.
+
+    The repairs that pull a window out of a split container move the focus
+    and are done with create_container() before the plan is sent. A repair
+    that is still needed afterwards, or in the dry run mode, is logged with
+    the plan.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    adopt : set, optional
+        Container ids of windows that should be moved into the split
+        containers (default none)
+
+    """
+    logging.info('Workspace::Reconcile')
+    info = get_workspace_info(ipc)
+    focused = info.focused
+    model = layout_model(info, adopt or ())
+    if model is None:
+        return
+    plan = layout_plan(info, model)
+    changed = False
+    for _ in range(2):
+        if not plan['deferred'] or DATA['dry_run']:
+            break
+        create_container(ipc, *plan['deferred'])
+        info = get_workspace_info(ipc)
+        plan = layout_plan(info, layout_model(info, adopt or ()))
+        changed = True
+    if plan['deferred'] and not DATA['dry_run']:
+        logging.warning('Workspace::Reconcile::Repair failed: %s',
+                        layout_commands(plan)[0])
+    layout_execute(ipc, [plan], focused, changed)
+
+
+def reconcile_plans(ipc, names=None, adopt=None):
+    """Plan the split containers of workspaces without moving the focus.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    names : iterable, optional
+        The names of the workspaces (default all)
+    adopt : set, optional
+        Container ids of windows in the main containers that should be moved
+        to the secondary containers, the unmanaged windows are always adopted
+        (default none)
+
+    Returns
+    -------
+    list
+        The plans of the workspaces that need changes.
+
+    """
+    plans = []
+    for node in tree_workspaces(ipc, names):
+        info = get_workspace_info(ipc, i3ipc.Con(node, None, ipc))
+        model = layout_model(info, set(info.unmanaged) | set(adopt or ()))
+        if model is None:
+            continue
+        plan = layout_plan(info, model)
+        if plan['deferred'] or any(plan[k] for k in
+                                   ['split', 'mark', 'move', 'layout']):
+            plans.append(plan)
+    return plans
+
+
+def reconcile_workspaces(ipc, names=None, adopt=None):
+    """Create the split containers and adopt the windows of workspaces.
+
+    The workspaces are reconciled without moving the focus, so that it works
+    on workspaces in the background, and the plans of all workspaces are
+    sent together by layout_execute(), which logs the deferred repairs.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    names : iterable, optional
+        The names of the workspaces (default all)
+    adopt : set, optional
+        Container ids of windows in the main containers that should be moved
+        to the secondary containers (default none)
+
+    Returns
+    -------
+    set
+        The names of the workspaces whose split containers need a repair that
+        is left to reconcile() when the workspace is focused.
+
+    """
+    logging.info('Workspace::Reconcile::%s',
+                 'All' if names is None else ', '.join(sorted(names)))
+    plans = reconcile_plans(ipc, names, adopt)
+    layout_execute(ipc, plans, FOCUS['current'])
+    return {p['workspace'] for p in plans if p['deferred']}
+
+
+@metered
+@buffered
 def on_window_close(ipc, event):
     """React on window close event.
 
@@ -853,23 +3407,16 @@ def on_window_close(ipc, event):
 
     """
     logging.info('Window::Close')
+    OPACITY['applied'].pop(event.container.id, None)
+    focus_forget(event.container.id)
     floating = event.container.floating
     if floating and floating.endswith('on'):
         return
-    info = get_workspace_info(ipc)
-    if info['mode'] == 'manual':
-        return
-    command = []
-    if not info['main']['id'] and info['scnd']['id']:
-        if len(info['scnd']['children']) == 1:
-            command.extend(rename_secondary_container(info))
-        else:
-            con_id = info['scnd']['children'][0]
-            create_container(ipc, 'main', con_id)
-            command.append('[con_id={}] focus'.format(con_id))
-    execute_commands(ipc, command)
+    coalesce(ipc, event)
 
 
+@metered
+@buffered
 def on_workspace_focus(ipc, event):
     """React on workspace focus event.
 
@@ -882,36 +3429,28 @@ def on_workspace_focus(ipc, event):
 
     """
     logging.info('Workspace::Focus::%s', event.current.name)
-    info = get_workspace_info(ipc, event.current)
-    command = []
-    if info['mode'] != 'manual':
-        if info['glbl']['layout'] == 'tabbed' or info['mode'] == 'monocle':
-            if DATA['hide_bar']:
-                os.system("polybar-msg cmd hide 1>/dev/null")
+    if dispatch_overtaken():
+        return
+    workspace = event.current
+    if workspace.name in COALESCE['pending']:
+        coalesce_flush(ipc, workspace.name)
+        workspace = None
+    info = get_workspace_info(ipc, workspace)
+    if info.mode != 'manual':
+        if info.glbl.layout == 'tabbed' or info.mode == 'monocle':
+            polybar('hide')
         else:
-            if DATA['hide_bar']:
-                os.system("polybar-msg cmd show 1>/dev/null")
-        if info['name'] not in I3DT_LAYOUT:
-            I3DT_LAYOUT[info['name']] = {'main': 'splitv', 'scnd': 'splitv'}
-        if info['unmanaged']:
-            if info['main']['id']:
-                if not info['scnd']['id']:
-                    create_container(ipc, 'scnd', info['unmanaged'][0])
-            elif len(info['unmanaged']) > 1:
-                unmanaged = info['unmanaged']
-                create_container(ipc, 'main', unmanaged[0])
-                create_container(ipc, 'scnd', unmanaged[1])
-            info = get_workspace_info(ipc)
-            if info['scnd']['id']:
-                for i in info['unmanaged']:
-                    command.append('[con_id={}] move to mark {}'
-                                   .format(i, info['scnd']['mark']))
+            polybar('show')
+        if info.name not in I3DT_LAYOUT:
+            I3DT_LAYOUT[info.name] = {'main': 'splitv', 'scnd': 'splitv'}
+        if info.unmanaged:
+            reconcile(ipc, set(info.unmanaged))
     else:
-        if DATA['hide_bar']:
-            os.system("polybar-msg cmd show 1>/dev/null")
-    execute_commands(ipc, command)
+        polybar('show')
 
 
+@metered
+@buffered
 def on_window_new(ipc, event):
     """React on window new event.
 
@@ -924,30 +3463,16 @@ def on_window_new(ipc, event):
 
     """
     logging.info('Window::New')
-    info = get_workspace_info(ipc)
-
     window = event.container
     is_bar = window.name and window.name.startswith('polybar')
     is_floating = window.floating and window.floating.endswith('on')
-    if info['mode'] == 'manual' or is_bar \
-            or is_floating or len(info['tiled']) < 2:
+    if is_bar or is_floating:
         return
-
-    if not info['main']['id']:
-        create_container(ipc, 'main', info['tiled'][0])
-        create_container(ipc, 'scnd', info['tiled'][1])
-    elif not info['scnd']['id']:
-        create_container(ipc, 'scnd')
-    else:
-        if info['focused'] in info['main']['children']:
-            commands = []
-            commands.append('[con_id={}] move to mark {}'
-                            .format(info['focused'], info['scnd']['mark']))
-            commands.append('[con_id={}] focus'
-                            .format(info['focused']))
-            execute_commands(ipc, commands, '')
+    coalesce(ipc, event, adopt=True)
 
 
+@metered
+@buffered
 def on_window_focus(ipc, event):
     """React on window focus event.
 
@@ -960,25 +3485,29 @@ def on_window_focus(ipc, event):
 
     """
     logging.info('Window::Focus')
+    # Focusing a parent container and the window again, as done when a split
+    # container is marked, does not change the focused window.
+    if event.container.id == FOCUS['current'] or dispatch_overtaken():
+        return
+    if echo_suppressed(event):
+        return
     FOCUS['previous'] = FOCUS['current']
     FOCUS['current'] = event.container.id
-    command = []
-    if DATA['variant'] == 'sway' and FOCUS['previous']:
-        info = get_workspace_info(ipc)
-        prev_key = find_parent_container_key(info, FOCUS['previous'])
-        if prev_key:
+    focus_record(event_workspace(event), event.container.id)
+    if DATA['variant'] == 'sway':
+        # Resolve the transition from the cached workspace information when
+        # the window is known.
+        info = OPACITY['info']
+        if info is None or FOCUS['current'] not in info.roles:
+            info = get_workspace_info(ipc)
+        command = opacity_commands(info, FOCUS['current'])
+        if command:
             logging.info('Window::Opacity')
-            curr_key = find_parent_container_key(info)
-            if curr_key != prev_key \
-                    or info[curr_key]['layout'] in ['splith', 'splitv']:
-                command.append('[con_id={}] opacity {}'
-                               .format(FOCUS['previous'],
-                                       DATA['opacity']['inactive']))
-        command.append('[con_id={}] opacity {}'
-                       .format(FOCUS['current'], DATA['opacity']['focused']))
         execute_commands(ipc, command, '')
 
 
+@metered
+@buffered
 def on_window_floating(ipc, event):
     """React on window floating toggle event.
 
@@ -991,33 +3520,11 @@ def on_window_floating(ipc, event):
 
     """
     logging.info('Window::Floating')
-    info = get_workspace_info(ipc)
-    if info['mode'] == 'manual':
-        return
-    command = []
-    if event.container.floating == 'user_off':
-        if info['scnd']['id']:
-            command.append('move to mark {}'
-                           .format(info['scnd']['mark']))
-        elif info['main']['id']:
-            create_container(ipc, 'scnd')
-        else:
-            if len(info['unmanaged']) > 1:
-                unmanaged = info['unmanaged']
-                create_container(ipc, 'main', unmanaged[0])
-                create_container(ipc, 'scnd', unmanaged[1])
-                info = get_workspace_info(ipc)
-                for cid in info['unmanaged']:
-                    command.append('[con_id={}] move to mark {}'
-                                   .format(cid, info['scnd']['id']))
-    elif not info['main']['id'] and info['scnd']['id']:
-        if len(info['scnd']['children']) == 1:
-            command.extend(rename_secondary_container(info))
-        else:
-            create_container(ipc, 'main', info['scnd']['children'][0])
-    execute_commands(ipc, command)
+    coalesce(ipc, event, adopt=event.container.floating == 'user_off')
 
 
+@metered
+@buffered
 def on_window_move(ipc, event):
     """React on window move event.
 
@@ -1029,50 +3536,33 @@ def on_window_move(ipc, event):
         An i3ipc window event
 
     """
-    # pylint: disable=unused-argument
     logging.info('Window:move')
-    info = get_workspace_info(ipc)
-    if info['mode'] == 'manual':
+    if echo_suppressed(event):
         return
-    command = []
-    if not info['main']['id'] and info['scnd']['id']:
-        if len(info['scnd']['children']) == 1:
-            command.extend(rename_secondary_container(info))
-        else:
-            create_container(ipc, 'main', info['scnd']['children'][0])
-    execute_commands(ipc, command)
+    coalesce(ipc, event)
 
 
-def i3ipc_layout(ipc, event):
+@metered
+def i3ipc_layout(ipc):
     """React on layout binding event.
 
     Parameters
     ----------
     ipc : i3ipc.Connection
         An i3ipc connection
-    event : i3ipc.BindingEvent
-        An i3ipc binding event
 
     """
-    # pylint: disable=unused-argument
     logging.info('Container::Layout')
     if DATA['variant'] != 'sway':
         return
     info = get_workspace_info(ipc)
     key = find_parent_container_key(info)
     if key:
-        command = []
-        opacity = DATA['opacity']['focused']
-        if info[key]['layout'] in ['splith', 'splitv']:
-            opacity = DATA['opacity']['inactive']
-        for cid in info[key]['children']:
-            if cid != info['focused']:
-                command.append('[con_id={}] opacity {}'.format(cid, opacity))
-        command.append('[con_id={}] opacity {}'
-                       .format(info['focused'], DATA['opacity']['focused']))
-        execute_commands(ipc, command, '')
+        execute_commands(ipc, opacity_commands(info, keys=[key]), '')
 
 
+@metered
+@buffered
 def on_binding(ipc, event):
     """React on selected binding events.
 
@@ -1084,27 +3574,101 @@ def on_binding(ipc, event):
         An i3ipc binding event
 
     """
-    if event.binding.command.startswith('nop'):
-        if event.binding.command.startswith('nop i3ipc_focus'):
-            i3ipc_focus(ipc, event)
-        elif event.binding.command.startswith('nop i3ipc_move'):
-            i3ipc_move(ipc, event)
-        elif event.binding.command == 'nop i3ipc_reflect':
+    coalesce_flush_all(ipc)
+    run_binding(ipc, event.binding.command)
+
+
+def run_binding(ipc, command):
+    """Run the action of a binding command.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    command : str
+        The command of the binding
+
+    Returns
+    -------
+    bool
+        True if the command is handled, False otherwise.
+
+    """
+    handled = True
+    if command.startswith('nop'):
+        if command.startswith('nop i3ipc_focus'):
+            i3ipc_focus(ipc, command)
+        elif command.startswith('nop i3ipc_move'):
+            i3ipc_move(ipc, command)
+        elif command == 'nop i3ipc_reflect':
             i3ipc_reflect(ipc)
-        elif event.binding.command == 'nop i3ipc_mirror':
+        elif command == 'nop i3ipc_mirror':
             i3ipc_mirror(ipc)
-        elif event.binding.command == 'nop i3ipc_monocle_toggle':
+        elif command == 'nop i3ipc_monocle_toggle':
             i3ipc_monocle_toggle(ipc)
-        elif event.binding.command == 'nop i3ipc_tabbed_toggle':
+        elif command == 'nop i3ipc_tabbed_toggle':
             i3ipc_tabbed_toggle(ipc)
-    elif event.binding.command == 'kill':
+        else:
+            handled = False
+    elif command == 'kill':
         i3ipc_kill(ipc)
-    elif event.binding.command == 'layout toggle tabbed split':
-        i3ipc_layout(ipc, event)
+    elif command == 'layout toggle tabbed split':
+        i3ipc_layout(ipc)
+    else:
+        handled = False
+    return handled
 
 
-def remove_opacity(ipc):
-    """Remove opacity from all windows.
+def signal_start(ipc):
+    """Handle the signals in a thread woken up through a self-pipe.
+
+    The signal handlers only write the signal number to the pipe. Logging or
+    taking a lock in signal context deadlocks when the interrupted main
+    thread holds the same lock.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+
+    """
+    SIGNALS['read'], SIGNALS['write'] = os.pipe()
+    os.set_blocking(SIGNALS['write'], False)
+
+    def handler(signum, _):
+        try:
+            os.write(SIGNALS['write'], bytes([signum]))
+        except BlockingIOError:
+            pass
+
+    for sig in [signal.SIGINT, signal.SIGTERM, signal.SIGUSR1,
+                signal.SIGUSR2]:
+        signal.signal(sig, handler)
+    SIGNALS['thread'] = threading.Thread(target=signal_loop, args=(ipc,),
+                                         daemon=True)
+    SIGNALS['thread'].start()
+
+
+def signal_loop(ipc):
+    """Handle the signals written to the self-pipe."""
+    while True:
+        try:
+            signum = os.read(SIGNALS['read'], 1)[0]
+        except (OSError, IndexError):
+            return
+        if signum in [signal.SIGINT, signal.SIGTERM]:
+            shutdown(ipc)
+        elif signum == signal.SIGUSR1:
+            metrics_dump()
+        elif signum == signal.SIGUSR2:
+            logging_dump(sys.stderr)
+
+
+def shutdown(ipc):
+    """Stop the main loop, called for SIGINT, SIGTERM and the quit command.
+
+    Nothing else is done here, the cleanup is done by remove_opacity() once
+    the main loop has returned.
 
     Parameters
     ----------
@@ -1112,11 +3676,56 @@ def remove_opacity(ipc):
         An i3ipc connection
 
     """
-    for workspace in ipc.get_tree().workspaces():
-        for wrk in workspace:
-            wrk.command("opacity 1")
+    logging.info('Shutdown')
+    if ASYNC['loop'] is not None:
+        async_quit()
     ipc.main_quit()
-    sys.exit(0)
+
+
+def remove_opacity(ipc):
+    """Save the state and remove opacity from all windows.
+
+    The pending timers are cancelled and the queued events reconciled right
+    away, so no window waiting to be adopted is lost, then the state is saved
+    and the opacity of every window that was changed is reset in one
+    command. The cleanup runs in a daemon thread that is abandoned after the
+    shutdown timeout, so an unresponsive window manager cannot stall the exit.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+
+    """
+    def cleanup():
+        with LOCK:
+            timers = list(COALESCE['timers'].values()) + [STATE['timer']]
+            for timer in timers:
+                if timer is not None:
+                    timer.cancel()
+            COALESCE['timers'].clear()
+            # The mirror no longer receives the events.
+            tree_invalidate()
+            try:
+                coalesce_flush_all(ipc)
+            except Exception:  # pylint: disable=broad-except
+                logging.exception('Shutdown::Reconcile')
+            COALESCE['pending'].clear()
+            state_save(ipc)
+            command = ['[con_id={}] opacity 1'.format(cid)
+                       for cid, opacity in OPACITY['applied'].items()
+                       if opacity != 1]
+            OPACITY['applied'].clear()
+            execute_commands(ipc, command, '')
+        if BAR['worker'] is not None:
+            BAR['queue'].join()
+
+    worker = threading.Thread(target=cleanup, daemon=True)
+    worker.start()
+    worker.join(DATA['shutdown_timeout'])
+    if worker.is_alive():
+        logging.warning('Shutdown::Timeout after %.1f s',
+                        DATA['shutdown_timeout'])
 
 
 def init(ipc):
@@ -1124,9 +3733,19 @@ def init(ipc):
     # Check if i3 or sway.
     if not DATA['initialized']:
         args = parse_arguments()
+        logging_setup(args.log_level, int(args.log_buffer))
         DATA['opacity']['focused'] = float(args.opacity_focused)
         DATA['opacity']['inactive'] = float(args.opacity_inactive)
         DATA['hide_bar'] = args.tabbed_hide_polybar.upper() == 'TRUE'
+        DATA['coalesce_delay'] = float(args.coalesce_delay)
+        DATA['asyncio'] = args.asyncio.upper() == 'TRUE'
+        DATA['polybar_ipc'] = args.polybar_ipc
+        DATA['state_file'] = args.state_file
+        DATA['state_interval'] = float(args.state_interval)
+        DATA['shutdown_timeout'] = float(args.shutdown_timeout)
+        DATA['profile_dir'] = args.profile_dir
+        DATA['workers'] = int(args.workers)
+        DATA['dry_run'] = args.dry_run.upper() == 'TRUE'
 
         # Workspaces to ignore.
         if args.workspaces_only:
@@ -1145,20 +3764,26 @@ def init(ipc):
 
         # Find the focused window and set opacity for all windows.
         command = []
-        for con in ipc.get_tree().leaves():
+        for con in i3ipc.Con(tree_sync(ipc), None, ipc).leaves():
             if con.focused:
                 FOCUS['current'] = con.id
-                if DATA['variant'] == 'sway':
-                    command.append(
-                        '[con_id={}] opacity {}'
-                        .format(con.id, DATA['opacity']['focused']))
-            else:
-                if DATA['variant'] == 'sway':
-                    command.append(
-                        '[con_id={}] opacity {}'
-                        .format(con.id, DATA['opacity']['inactive']))
+                focus_record(tree_workspace(con.id)['name'], con.id)
+            if DATA['variant'] == 'sway':
+                opacity = DATA['opacity']['inactive']
+                if con.focused:
+                    opacity = DATA['opacity']['focused']
+                OPACITY['applied'][con.id] = opacity
+                command.append('[con_id={}] opacity {}'
+                               .format(con.id, opacity))
         execute_commands(ipc, command, '')
 
+        # Resume from the state of a previous instance and tile the
+        # workspaces before they are focused.
+        state_load(ipc)
+        reconcile_workspaces(ipc)
+        if DATA['state_interval'] > 0:
+            state_schedule(ipc)
+
 
 def parse_arguments():
     """Parse command line arguments."""
@@ -1175,6 +3800,13 @@ def parse_arguments():
         help="""The logging level: debug, info [default], warning, error, or
         critical.""")
 
+    parser.add_argument(
+        '--log-buffer',
+        default='0',
+        help="""The number of recent debug records kept in memory, which are
+        dumped on SIGUSR2 or with the 'log' command of the control socket.
+        Zero disables it.""")
+
     parser.add_argument(
         '--workspaces-ignore',
         nargs='*',
@@ -1205,6 +3837,78 @@ def parse_arguments():
         default='false',
         help="""Hide the polybar when in tabbed mode [false, true].""")
 
+    parser.add_argument(
+        '--polybar-ipc',
+        default='/tmp/polybar_mqueue.*',
+        help="""The pattern of the polybar IPC FIFOs, polybar-msg is used if
+        none exists.""")
+
+    parser.add_argument(
+        '--state-file',
+        default=os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                             'i3ipc-dynamic-tiling.json'),
+        help="""The file the state is saved to and restored from on restart.
+        An empty string disables it.""")
+
+    parser.add_argument(
+        '--state-interval',
+        default='60',
+        help="""Seconds between the periodic saves of the state. Zero only
+        saves the state on exit.""")
+
+    parser.add_argument(
+        '--control-socket',
+        default=os.path.join(os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+                             'i3ipc-dynamic-tiling.sock'),
+        help="""The Unix socket that accepts the binding commands and makes
+        sure that only one instance runs. An empty string disables it.""")
+
+    parser.add_argument(
+        '--command',
+        nargs='+',
+        help="""Send a command, for example 'i3ipc_focus next', to the
+        running instance over the control socket and exit.""")
+
+    parser.add_argument(
+        '--profile-dir',
+        default=os.environ.get('XDG_RUNTIME_DIR', '/tmp'),
+        help="""The directory the profiles started over the control socket
+        are written to.""")
+
+    parser.add_argument(
+        '--shutdown-timeout',
+        default='1',
+        help="""Seconds that the cleanup on exit may take before the
+        process exits anyway.""")
+
+    parser.add_argument(
+        '--coalesce-delay',
+        default='0.02',
+        help="""Seconds to gather window new, move, close and floating events
+        of a workspace before reconciling them in one pass. Zero disables the
+        delay.""")
+
+    parser.add_argument(
+        '--workers',
+        default='1',
+        help="""Threads handling the events from per-workspace queues, so
+        that a slow handler does not delay reading the next events. The
+        handlers are serialized and still run one at a time. Zero handles
+        the events in order on the thread reading them. Defaults to one.""")
+
+    parser.add_argument(
+        '--dry-run',
+        default='false',
+        help="""Log the commands planned to create the split containers and
+        adopt windows instead of sending them [false, true].""")
+
+    parser.add_argument(
+        '--asyncio',
+        default='false',
+        help="""Read the events on an asyncio event loop, which requests the
+        tree for the next queued event and sends the opacity commands while
+        the handlers run [false, true].""")
+
     args = parser.parse_args()
 
     # Check the logging level argument.
@@ -1212,10 +3916,34 @@ def parse_arguments():
     if not isinstance(log_level_numeric, int):
         raise ValueError('Invalid log level: {}'.format(args.log_level))
 
+    if int(args.log_buffer) < 0:
+        raise ValueError('Invalid log buffer: {}'.format(args.log_buffer))
+
+    if float(args.state_interval) < 0:
+        raise ValueError('Invalid state interval: {}'
+                         .format(args.state_interval))
+
+    if float(args.shutdown_timeout) < 0:
+        raise ValueError('Invalid shutdown timeout: {}'
+                         .format(args.shutdown_timeout))
+
+    if int(args.workers) < 0:
+        raise ValueError('Invalid workers: {}'.format(args.workers))
+
+    if float(args.coalesce_delay) < 0:
+        raise ValueError('Invalid coalesce delay: {}'
+                         .format(args.coalesce_delay))
+
     if args.tabbed_hide_polybar.upper() not in ['FALSE', 'TRUE']:
         raise ValueError('Invalid hide polybar tabbed argument: {}'
                          .format(args.tabbed_hide_polybar))
 
+    if args.dry_run.upper() not in ['FALSE', 'TRUE']:
+        raise ValueError('Invalid dry run argument: {}'.format(args.dry_run))
+
+    if args.asyncio.upper() not in ['FALSE', 'TRUE']:
+        raise ValueError('Invalid asyncio argument: {}'.format(args.asyncio))
+
     # Check the workspace ignore argument.
     msg = 'Invalid ignore workspace: {}'.format(args.workspaces_ignore)
     for wrk in args.workspaces_ignore:
@@ -1230,22 +3958,66 @@ def parse_arguments():
     return args
 
 
+def subscribe(ipc, on=None):
+    """Subscribe the event handlers and start the workers handling them.
+
+    Parameters
+    ----------
+    ipc : i3ipc.Connection
+        An i3ipc connection
+    on : callable, optional
+        The function used to subscribe a handler to an event (default
+        ipc.on)
+
+    """
+    on = on or ipc.on
+    dispatch_start(ipc)
+    on(Event.WINDOW, dispatched(tree_on_window))
+    on(Event.WORKSPACE, dispatched(tree_on_workspace))
+    on(Event.BINDING, dispatched(tree_on_binding))
+    on(Event.BINDING, dispatched(on_binding))
+    on(Event.WINDOW_CLOSE, dispatched(on_window_close))
+    on(Event.WINDOW_FLOATING, dispatched(on_window_floating))
+    on(Event.WINDOW_FOCUS, dispatched(on_window_focus))
+    on(Event.WINDOW_MOVE, dispatched(on_window_move))
+    on(Event.WINDOW_NEW, dispatched(on_window_new))
+    on(Event.WORKSPACE_FOCUS, dispatched(on_workspace_focus))
+
+
 if __name__ == "__main__":
+    ARGS = parse_arguments()
+    if ARGS.command:
+        try:
+            REPLY = control_send(ARGS.control_socket, ' '.join(ARGS.command))
+        except OSError as error:
+            REPLY = {'success': False, 'error': str(error)}
+        if not REPLY['success']:
+            sys.stderr.write('{}\n'.format(REPLY['error']))
+        elif isinstance(REPLY.get('result'), str):
+            sys.stdout.write('{}\n'.format(REPLY['result']))
+        elif 'result' in REPLY:
+            sys.stdout.write('{}\n'.format(json.dumps(REPLY['result'],
+                                                       indent=2)))
+        sys.exit(0 if REPLY['success'] else 1)
+
+    if ARGS.control_socket:
+        control_listen(ARGS.control_socket,
+                       float(ARGS.shutdown_timeout) + 1.0)
+
     IPC = i3ipc.Connection()
 
     init(IPC)
+    control_start(IPC)
 
-    for sig in [signal.SIGINT, signal.SIGTERM]:
-        signal.signal(sig, lambda signal, frame: remove_opacity(IPC))
+    signal_start(IPC)
 
     try:
-        IPC.on(Event.BINDING, on_binding)
-        IPC.on(Event.WINDOW_CLOSE, on_window_close)
-        IPC.on(Event.WINDOW_FLOATING, on_window_floating)
-        IPC.on(Event.WINDOW_FOCUS, on_window_focus)
-        IPC.on(Event.WINDOW_MOVE, on_window_move)
-        IPC.on(Event.WINDOW_NEW, on_window_new)
-        IPC.on(Event.WORKSPACE_FOCUS, on_workspace_focus)
-        IPC.main()
+        if DATA['asyncio']:
+            asyncio.run(main_async(IPC))
+        else:
+            subscribe(IPC)
+            IPC.main()
     finally:
-        IPC.main_quit()
+        dispatch_stop()
+        remove_opacity(IPC)
+        control_close()